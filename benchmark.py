@@ -0,0 +1,400 @@
+# benchmark.py - Offline load test for FileAccessBot against a fake Bot API
+#
+# Drives the real handlers through Application.process_update with synthetic
+# update streams, while an in-process stand-in answers Bot API calls with
+# configurable latency and error injection. No network access is needed.
+#
+#   python benchmark.py --scenarios redeem,upload --updates 2000 --rate 500
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from telegram import Update
+from telegram.ext import Application, CallbackContext
+from telegram.request import BaseRequest, RequestData
+
+BOT_ID = 1000
+OWNER_ID = 1
+
+
+class FakeBotAPI(BaseRequest):
+    """In-process stand-in for the Bot API with latency and error injection"""
+
+    # getMe must succeed for the application to initialize
+    NO_FAULTS = {'getMe', 'setWebhook'}
+
+    def __init__(self, latency: float = 0.02, jitter: float = 0.005, error_rate: float = 0.0,
+                 flood_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         *args, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+
+        await asyncio.sleep(max(0.0, self.random.gauss(self.latency, self.jitter)))
+
+        if endpoint not in self.NO_FAULTS:
+            roll = self.random.random()
+            if roll < self.flood_rate:
+                return 429, self._error(429, "Too Many Requests: retry after 1", {'retry_after': 1})
+            if roll < self.flood_rate + self.error_rate:
+                return 400, self._error(400, "Bad Request: injected failure")
+
+        return 200, json.dumps({'ok': True, 'result': self._result(endpoint, params)}).encode()
+
+    @staticmethod
+    def _error(code: int, description: str, parameters: dict = None) -> bytes:
+        payload = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            payload['parameters'] = parameters
+        return json.dumps(payload).encode()
+
+    def _message(self, chat_id, **extra) -> dict:
+        self._message_id += 1
+        message = {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+        }
+        message.update(extra)
+        return message
+
+    def _result(self, endpoint: str, params: dict):
+        if endpoint == 'getMe':
+            return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if endpoint == 'getChatMember':
+            user = {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'user'}
+            return {'status': 'member', 'user': user}
+        if endpoint == 'sendMessage':
+            return self._message(params['chat_id'], text=params.get('text', ''))
+        if endpoint == 'sendDocument':
+            document = {'file_id': str(params.get('document', 'doc')), 'file_unique_id': 'u'}
+            return self._message(params['chat_id'], document=document)
+        if endpoint == 'editMessageText':
+            return self._message(params.get('chat_id', OWNER_ID), text=params.get('text', ''))
+        return True
+
+
+class UpdateFactory:
+    """Builds synthetic private-chat updates"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+
+    def _build(self, user_id: int, message: dict) -> Update:
+        self.update_id += 1
+        message.update({
+            'message_id': self.update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+        })
+        return Update.de_json({'update_id': self.update_id, 'message': message}, self.bot)
+
+    def text(self, user_id: int, text: str) -> Update:
+        return self._build(user_id, {'text': text})
+
+    def command(self, user_id: int, command: str, *args: str) -> Update:
+        text = ' '.join((f'/{command}',) + args)
+        entity = {'type': 'bot_command', 'offset': 0, 'length': len(command) + 1}
+        return self._build(user_id, {'text': text, 'entities': [entity]})
+
+    def document(self, user_id: int, file_id: str) -> Update:
+        document = {'file_id': file_id, 'file_unique_id': file_id, 'file_name': f'{file_id}.bin'}
+        return self._build(user_id, {'document': document})
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Benchmark:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.api = FakeBotAPI(args.api_latency, args.api_jitter, args.error_rate, args.flood_rate, args.seed)
+        self.random = random.Random(args.seed)
+        self.results: List[dict] = []
+
+    async def setup(self):
+        import main
+
+        storage = None
+        if self.args.backend == 'fakeredis':
+            import fakeredis
+            from redis.asyncio import BlockingConnectionPool
+            storage = main.RedisBackend(fakeredis.FakeAsyncRedis(
+                decode_responses=True, connection_pool_class=BlockingConnectionPool, max_connections=64
+            ))
+        self.bot = main.FileAccessBot(bot_token="123456:BENCH", owner_id=OWNER_ID, backup_channel_id="@bench",
+                                      storage=storage)
+        if storage is not None:
+            storage.attach_metrics(self.bot.metrics)
+        self.app: Application = self.bot.build_application(request=self.api)
+        await self.app.initialize()
+        self.updates = UpdateFactory(self.app.bot)
+
+        # Seed the catalog before post_init so the access-code cache warms with it
+        rows = [(f"file-{i}", f"File {i}", OWNER_ID) for i in range(self.args.catalog)]
+        self.codes = await self.bot.code_allocator.insert_files(rows)
+        await self.bot.post_init(self.app)
+
+    async def teardown(self):
+        await self.app.shutdown()
+        await self.bot.post_shutdown(self.app)
+
+    async def _timed(self, update: Update, latencies: List[float]):
+        start = time.perf_counter()
+        # Go through the update processor so dispatch lanes and shedding are measured too
+        await self.app.update_processor.process_update(update, self.app.process_update(update))
+        latencies.append(time.perf_counter() - start)
+
+    async def _drive(self, name: str, flows: list):
+        """Start each flow at the target rate (open loop) and record per-update latency"""
+        latencies: List[float] = []
+        db_before = self.bot.metrics.total('db_duration_seconds')
+        errors_before = self.bot.metrics.total('handler_calls_total', outcome='error')
+        api_before = sum(self.api.calls.values())
+
+        async def run_flow(flow):
+            for update in flow():
+                await self._timed(update, latencies)
+
+        tasks = []
+        start = time.perf_counter()
+        for i, flow in enumerate(flows):
+            delay = start + i / self.args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(run_flow(flow)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+        count = len(latencies)
+        self.results.append({
+            'scenario': name,
+            'updates': count,
+            'errors': int(self.bot.metrics.total('handler_calls_total', outcome='error') - errors_before),
+            'api_calls': sum(self.api.calls.values()) - api_before,
+            'seconds': round(elapsed, 3),
+            'updates_per_sec': round(count / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'db_ms_per_update': round((self.bot.metrics.total('db_duration_seconds') - db_before) * 1000 / max(count, 1), 3),
+        })
+
+    def _user(self, base: int) -> int:
+        return base + self.random.randrange(self.args.users)
+
+    async def scenario_redeem(self):
+        """Valid access codes from many users (handle_message -> handle_access_code)"""
+        flows = []
+        for _ in range(self.args.updates):
+            update = self.updates.text(self._user(100_000), self.random.choice(self.codes))
+            flows.append(lambda update=update: [update])
+        await self._drive('redeem', flows)
+
+    async def scenario_repeat(self):
+        """The same code tapped four times in a row by each user"""
+        flows = []
+        for i in range(self.args.updates // 4):
+            user_id, code = 150_000 + i, self.random.choice(self.codes)
+            flows.append(lambda user_id=user_id, code=code: (self.updates.text(user_id, code) for _ in range(4)))
+        await self._drive('repeat', flows)
+
+    async def scenario_invalid(self):
+        """Unknown access codes, exercising the miss path and the invalid-code lockout"""
+        flows = []
+        for i in range(self.args.updates):
+            update = self.updates.text(self._user(200_000), f"ZZ{i:06d}"[-8:])
+            flows.append(lambda update=update: [update])
+        await self._drive('invalid', flows)
+
+    async def scenario_upload(self):
+        """/upload, description, document sessions from authorized uploaders"""
+        sessions = max(1, self.args.updates // 3)
+        uploaders = list(range(300_000, 300_000 + sessions))
+        for user_id in uploaders:
+            await self.bot.auth.authorize(user_id, OWNER_ID)
+
+        def session(user_id: int):
+            yield self.updates.command(user_id, 'upload')
+            yield self.updates.text(user_id, f"Upload by {user_id}")
+            yield self.updates.document(user_id, f"bench-{user_id}")
+        await self._drive('upload', [lambda user_id=user_id: session(user_id) for user_id in uploaders])
+
+    async def scenario_bulk(self):
+        """/bulk_upload, a stream of documents, then /done storing them in one transaction"""
+        uploader = 350_000
+        await self.bot.auth.authorize(uploader, OWNER_ID)
+
+        def session():
+            yield self.updates.command(uploader, 'bulk_upload')
+            for i in range(self.args.updates):
+                yield self.updates.document(uploader, f"bulk-{i}")
+            yield self.updates.command(uploader, 'done')
+        await self._drive('bulk', [session])
+
+    async def scenario_broadcast(self):
+        """/broadcast to the users table, timed until the background job finishes"""
+        rows = [(user_id, None, None) for user_id in range(400_000, 400_000 + self.args.users)]
+        await self.bot.storage.add_users(rows)
+
+        sends_before = self.api.calls['sendMessage']
+        start = time.perf_counter()
+        await self._drive('broadcast_command', [lambda: [self.updates.command(OWNER_ID, 'broadcast', 'hello')]])
+        await self.bot.broadcast_engine.join()
+        elapsed = time.perf_counter() - start
+        sent = self.api.calls['sendMessage'] - sends_before
+        self.results.append({
+            'scenario': 'broadcast_delivery',
+            'updates': sent,
+            'seconds': round(elapsed, 3),
+            'updates_per_sec': round(sent / elapsed, 1) if elapsed else 0.0,
+        })
+
+    async def scenario_priority(self):
+        """Owner commands during a redemption burst well past the redemption lane's capacity"""
+        flood: List[float] = []
+        owner: List[float] = []
+        shed_before = self.bot.metrics.total('shed_updates_total')
+
+        async def owner_commands():
+            for _ in range(20):
+                await self._timed(self.updates.command(OWNER_ID, 'list_files'), owner)
+                await asyncio.sleep(0.01)
+
+        burst = [self.updates.text(self._user(600_000), self.random.choice(self.codes))
+                 for _ in range(self.args.updates * 4)]
+        start = time.perf_counter()
+        await asyncio.gather(owner_commands(), *(self._timed(update, flood) for update in burst))
+        elapsed = time.perf_counter() - start
+        shed = int(self.bot.metrics.total('shed_updates_total') - shed_before)
+        for name, latencies, shed in (('priority_flood', flood, shed), ('priority_owner', owner, 0)):
+            self.results.append({
+                'scenario': name,
+                'updates': len(latencies),
+                'shed': shed,
+                'seconds': round(elapsed, 3),
+                'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            })
+
+    async def scenario_sweep(self):
+        """delete_file_callback over a backlog of due shared_files rows"""
+        due = datetime.now() - timedelta(seconds=1)
+        await asyncio.gather(*(self.bot.storage.add_share(i, 500_000 + i, f"file-{i}", due)
+                               for i in range(self.args.updates)))
+
+        db_before = self.bot.metrics.total('db_duration_seconds')
+        deletes_before = self.api.calls['deleteMessage']
+        start = time.perf_counter()
+        await self.bot.delete_file_callback(CallbackContext(self.app))
+        elapsed = time.perf_counter() - start
+        deleted = self.api.calls['deleteMessage'] - deletes_before
+        self.results.append({
+            'scenario': 'sweep',
+            'updates': deleted,
+            'seconds': round(elapsed, 3),
+            'updates_per_sec': round(deleted / elapsed, 1) if elapsed else 0.0,
+            'db_ms_per_update': round((self.bot.metrics.total('db_duration_seconds') - db_before) * 1000 / max(deleted, 1), 3),
+        })
+
+    async def run(self) -> List[dict]:
+        await self.setup()
+        try:
+            for name in self.args.scenarios.split(','):
+                await getattr(self, f"scenario_{name.strip()}")()
+        finally:
+            await self.teardown()
+        return self.results
+
+
+def print_table(results: List[dict]):
+    columns = ['scenario', 'updates', 'errors', 'shed', 'api_calls', 'seconds', 'updates_per_sec',
+               'p50_ms', 'p99_ms', 'db_ms_per_update']
+    widths = {c: max(len(c), *(len(str(r.get(c, '-'))) for r in results)) for c in columns}
+    print('  '.join(c.ljust(widths[c]) for c in columns))
+    for result in results:
+        print('  '.join(str(result.get(c, '-')).ljust(widths[c]) for c in columns))
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark for FileAccessBot")
+    parser.add_argument('--scenarios', default='redeem,repeat,invalid,upload,bulk,broadcast,priority,sweep',
+                        help="comma-separated list of: redeem, repeat, invalid, upload, bulk, broadcast, priority, "
+                             "sweep")
+    parser.add_argument('--updates', type=int, default=1000, help="updates (or rows) per scenario")
+    parser.add_argument('--rate', type=float, default=500, help="target update arrival rate per second")
+    parser.add_argument('--users', type=int, default=5000, help="distinct simulated users")
+    parser.add_argument('--catalog', type=int, default=1000, help="files seeded before the run")
+    parser.add_argument('--api-latency', type=float, default=0.02, help="mean fake Bot API latency (s)")
+    parser.add_argument('--api-jitter', type=float, default=0.005, help="stddev of fake Bot API latency (s)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of calls failing with 400")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="fraction of calls failing with 429")
+    parser.add_argument('--send-rate', type=float, default=1000,
+                        help="bot-wide, broadcast and deletion send rate limits (msg/s) used during the run")
+    parser.add_argument('--backend', choices=['sqlite', 'fakeredis'], default='sqlite',
+                        help="state backend; fakeredis runs the Redis backend in-process (needs fakeredis)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]) -> int:
+    args = parse_args(argv)
+
+    # Measure the pipeline, not the production flood limits
+    os.environ.pop('PORT', None)
+    os.environ.setdefault('GLOBAL_RATE_LIMIT', '1e9')
+    os.environ.setdefault('USER_RATE_LIMIT', '1e9')
+    os.environ['SEND_RATE'] = str(args.send_rate)
+    os.environ['BROADCAST_RATE'] = str(args.send_rate)
+    os.environ['DELETION_RATE'] = str(args.send_rate)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    logging.disable(logging.WARNING)
+
+    # The bot writes file_bot.db to the working directory; keep it out of the caller's tree
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bot-bench-") as workdir:
+        os.chdir(workdir)
+        try:
+            results = asyncio.run(Benchmark(args).run())
+        finally:
+            os.chdir(cwd)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
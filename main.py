@@ -1,17 +1,41 @@
 # main.py - Debug version with better error handling
 import os
+import re
 import asyncio
+import hmac
+import json
+import math
+import signal
 import sqlite3
 import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, Set
+from http import HTTPStatus
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import calendar
 import hashlib
-import random
+import html
+import csv
+import io
+import secrets
+import socket
 import string
+from contextlib import contextmanager
+from functools import wraps
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-from telegram.error import TelegramError
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot, InputFile, Message
+from telegram.ext import (Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler,
+                          ContextTypes, filters)
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import BaseRequest, HTTPXRequest
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Only needed for STATE_BACKEND=redis
+    aioredis = None
 
 # Configure logging with more detail
 logging.basicConfig(
@@ -20,120 +44,2865 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-print("Starting Telegram File Access Bot...")
-logger.info("Bot initialization starting...")
+print("Starting Telegram File Access Bot...")
+logger.info("Bot initialization starting...")
+
+class Metrics:
+    """Prometheus-style counters, gauges and histograms rendered as text exposition"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._gauges: Dict[str, Dict[tuple, float]] = {}
+        # Per series: one count per bucket, then +Inf count and sum
+        self._histograms: Dict[str, Dict[tuple, List[float]]] = {}
+        self._callbacks: Dict[str, Callable[[], float]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._help[name] = (kind, help_text)
+
+    @staticmethod
+    def _key(labels: Optional[Dict[str, str]]) -> tuple:
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name: str, labels: Dict[str, str] = None, value: float = 1.0):
+        series = self._counters.setdefault(name, {})
+        key = self._key(labels)
+        series[key] = series.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, labels: Dict[str, str] = None):
+        self._gauges.setdefault(name, {})[self._key(labels)] = value
+
+    def callback(self, name: str, fn: Callable[[], float]):
+        """Register a value read at scrape time, e.g. the size of an in-memory structure"""
+        self._callbacks[name] = fn
+
+    def observe(self, name: str, value: float, labels: Dict[str, str] = None):
+        series = self._histograms.setdefault(name, {})
+        key = self._key(labels)
+        counts = series.get(key)
+        if counts is None:
+            counts = series[key] = [0.0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, name: str, labels: Dict[str, str] = None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    def instrument(self, command: str, handler: Callable) -> Callable:
+        """Wrap a handler with latency and outcome metrics"""
+        @wraps(handler)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = 'ok'
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                outcome = 'error'
+                raise
+            finally:
+                labels = {'command': command, 'outcome': outcome}
+                self.observe('handler_duration_seconds', time.perf_counter() - start, labels)
+                self.inc('handler_calls_total', labels)
+        return wrapper
+
+    def total(self, name: str, **labels) -> float:
+        """Sum a counter, or a histogram's observed values, over series matching labels"""
+        wanted = set(labels.items())
+        total = 0.0
+        for key, value in self._counters.get(name, {}).items():
+            if wanted <= set(key):
+                total += value
+        for key, counts in self._histograms.get(name, {}).items():
+            if wanted <= set(key):
+                total += counts[-1]
+        return total
+
+    @staticmethod
+    def _format(name: str, key: tuple, value: float, extra: tuple = ()) -> str:
+        labels = ','.join(f'{k}="{v}"' for k, v in key + extra)
+        return f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+
+    def render(self) -> str:
+        lines = []
+        def header(name: str, default_kind: str):
+            kind, help_text = self._help.get(name, (default_kind, ''))
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+        
+        for name, series in self._counters.items():
+            header(name, 'counter')
+            lines.extend(self._format(name, key, value) for key, value in series.items())
+        for name, series in self._gauges.items():
+            header(name, 'gauge')
+            lines.extend(self._format(name, key, value) for key, value in series.items())
+        for name, fn in self._callbacks.items():
+            header(name, 'gauge')
+            lines.append(self._format(name, (), fn()))
+        for name, series in self._histograms.items():
+            header(name, 'histogram')
+            for key, counts in series.items():
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(self._format(f"{name}_bucket", key, count, (('le', str(bound)),)))
+                lines.append(self._format(f"{name}_bucket", key, counts[-2], (('le', '+Inf'),)))
+                lines.append(self._format(f"{name}_count", key, counts[-2]))
+                lines.append(self._format(f"{name}_sum", key, counts[-1]))
+        return '\n'.join(lines) + '\n'
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and outcome of every Bot API call"""
+
+    def __init__(self, metrics: Metrics, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> Tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            labels = {'method': endpoint, 'status': status}
+            self.metrics.observe('telegram_api_duration_seconds', time.perf_counter() - start, labels)
+            self.metrics.inc('telegram_api_calls_total', labels)
+
+class StateBackend:
+    """Repository API shared by the single-node and networked state backends
+
+    Components only talk to this interface, so the same bot can keep its
+    state in a local SQLite file or in a server shared by several workers.
+    Backends with shared=True are visible to other processes, which turns
+    off optimizations that assume this process sees every write.
+    """
+
+    shared = False
+
+    async def warm_up(self):
+        """Establish connections ahead of the first request"""
+
+    async def close(self):
+        raise NotImplementedError
+
+    async def add_users(self, rows: List[Tuple[int, Optional[str], Optional[str]]]) -> int:
+        raise NotImplementedError
+
+    async def all_user_ids(self) -> List[int]:
+        raise NotImplementedError
+
+    async def count_users(self) -> int:
+        raise NotImplementedError
+
+    async def user_ids_after(self, after_user_id: int, limit: int) -> List[int]:
+        raise NotImplementedError
+
+    async def get_file(self, access_code: str) -> Optional[Tuple[str, str]]:
+        raise NotImplementedError
+
+    async def load_files(self, limit: int = -1) -> list:
+        raise NotImplementedError
+
+    async def insert_files(self, rows: List[Tuple[str, str, int]], codes: List[str],
+                           new_code: Callable[[], str], max_attempts: int = 10) -> List[str]:
+        raise NotImplementedError
+
+    async def list_files(self, before_id: int = None, limit: int = 20, uploaded_by: int = None,
+                         query: str = None) -> Tuple[list, Optional[int]]:
+        """Return one page of files, newest first, and the cursor for the next
+
+        Rows are (id, access_code, filename, upload_date, uploaded_by,
+        redemptions). The cursor is None on the last page.
+        """
+        raise NotImplementedError
+
+    async def record_redemptions(self, events: List[Tuple[float, int, str, str]]):
+        """Append (timestamp, user_id, access_code, outcome) events and update the aggregates
+
+        Only outcome 'sent' counts as a redemption in the per-code, per-day
+        and unique-user counters; every outcome is kept in the event log.
+        """
+        raise NotImplementedError
+
+    async def redemption_totals(self) -> Tuple[int, int]:
+        """Return (redemptions, unique users) over all time"""
+        raise NotImplementedError
+
+    async def daily_stats(self, days: List[str]) -> List[Tuple[str, int, int]]:
+        """Return (day, redemptions, unique users) for each YYYY-MM-DD day given"""
+        raise NotImplementedError
+
+    async def top_files(self, limit: int = 10) -> List[Tuple[str, Optional[str], int]]:
+        """Return (access_code, filename, redemptions) for the most redeemed files"""
+        raise NotImplementedError
+
+    async def redemption_events(self, start: float, end: float, cursor=None, limit: int = 5000) -> Tuple[list, object]:
+        """Return a page of (timestamp, user_id, access_code, outcome) events in [start, end)
+
+        The returned cursor continues the export and is None after the last page.
+        """
+        raise NotImplementedError
+
+    async def add_share(self, message_id: int, chat_id: int, file_id: str, delete_at: datetime,
+                        access_code: str = None) -> int:
+        """Schedule a shared message for deletion and return the share id"""
+        raise NotImplementedError
+
+    async def find_share(self, chat_id: int, access_code: str, now: datetime) -> Optional[Tuple[int, int, datetime]]:
+        """Return (id, message_id, delete_at) of the newest undeleted share of a code in a chat"""
+        raise NotImplementedError
+
+    async def active_shares(self, now: datetime) -> list:
+        """Return (id, message_id, chat_id, access_code, delete_at) for every share not yet due"""
+        raise NotImplementedError
+
+    async def extend_share(self, share_id: int, delete_at: datetime) -> int:
+        """Move a pending share's deletion time; 0 if it was already swept"""
+        raise NotImplementedError
+
+    async def due_shares(self, now: datetime, limit: int) -> list:
+        raise NotImplementedError
+
+    async def remove_shares(self, share_ids: List[int]) -> int:
+        raise NotImplementedError
+
+    async def count_shares(self) -> int:
+        raise NotImplementedError
+
+    async def create_broadcast(self, text: str, status_chat_id: int, status_message_id: int) -> int:
+        raise NotImplementedError
+
+    async def save_broadcast_progress(self, broadcast_id: int, last_user_id: int, sent: int, failed: int,
+                                      status: str = 'running'):
+        raise NotImplementedError
+
+    async def running_broadcasts(self) -> list:
+        raise NotImplementedError
+
+    async def authorized_uploader_ids(self) -> List[int]:
+        raise NotImplementedError
+
+    async def authorize_uploader(self, user_id: int, authorized_by: int) -> int:
+        raise NotImplementedError
+
+    async def revoke_uploader(self, user_id: int) -> int:
+        raise NotImplementedError
+
+    async def save_upload_state(self, user_id: int, step: str, description: Optional[str],
+                                files: List[Tuple[str, str]], expires_at: float):
+        raise NotImplementedError
+
+    async def append_upload_file(self, user_id: int, entry: Tuple[str, str], expires_at: float) -> bool:
+        """Atomically add one file to a user's upload state and extend it; False if there is no state"""
+        raise NotImplementedError
+
+    async def get_upload_state(self, user_id: int) -> Optional[tuple]:
+        raise NotImplementedError
+
+    async def pop_upload_state(self, user_id: int) -> Optional[tuple]:
+        """Atomically remove a user's upload state and return it"""
+        raise NotImplementedError
+
+    async def delete_upload_state(self, user_id: int):
+        raise NotImplementedError
+
+    async def load_upload_states(self, now: float) -> list:
+        raise NotImplementedError
+
+    async def incr_counter(self, key: str, amount: int = 1, ttl: float = None) -> int:
+        """Add amount to a counter and return the new value
+
+        A ttl starts when the counter is created and is not extended by
+        later increments, which makes fixed-window rate counters.
+        """
+        raise NotImplementedError
+
+    async def get_counter(self, key: str) -> int:
+        raise NotImplementedError
+
+    async def counter_ttl(self, key: str) -> float:
+        """Seconds until a counter expires; 0 if it does not exist or never expires"""
+        raise NotImplementedError
+
+    async def acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        """Take or extend a lease on name; False while another owner holds it"""
+        raise NotImplementedError
+
+    async def release_lock(self, name: str, owner: str):
+        raise NotImplementedError
+
+    async def purge_expired(self):
+        """Drop expired counters and locks where the backend does not do it itself"""
+
+# Schema migrations, applied in order and tracked in PRAGMA user_version.
+# Databases created before versioning report version 0 with some prefix of
+# these tables already present, so the first six are written to be re-runnable.
+
+def _migrate_base_tables(cursor: sqlite3.Cursor):
+    """Users, files, uploaders and shared files"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            joined_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            access_code TEXT UNIQUE NOT NULL,
+            file_id TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            uploaded_by INTEGER NOT NULL,
+            upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS authorized_uploaders (
+            user_id INTEGER PRIMARY KEY,
+            authorized_by INTEGER NOT NULL,
+            authorized_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shared_files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            shared_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delete_at TIMESTAMP NOT NULL
+        )
+    ''')
+
+def _migrate_background_jobs(cursor: sqlite3.Cursor):
+    """Deletion schedule index, broadcast cursors and pending uploads"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_shared_files_delete_at ON shared_files(delete_at)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status_chat_id INTEGER NOT NULL,
+            status_message_id INTEGER NOT NULL,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'running',
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_uploads (
+            user_id INTEGER PRIMARY KEY,
+            step TEXT NOT NULL,
+            description TEXT,
+            files TEXT NOT NULL DEFAULT '[]',
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+def _migrate_counters_and_locks(cursor: sqlite3.Cursor):
+    """Expiring counters and leases (rate limits and job locks)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS counters (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL,
+            expires_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS locks (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+def _migrate_catalog(cursor: sqlite3.Cursor):
+    """Per-uploader listing, FTS5 filename search and per-file redemption counts"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_uploaded_by ON files(uploaded_by, id)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS file_stats (
+            access_code TEXT PRIMARY KEY,
+            redemptions INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'files_fts'").fetchone():
+        return
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE files_fts USING fts5(filename, content='files', content_rowid='id')")
+    except sqlite3.OperationalError as e:
+        logger.warning(f"FTS5 unavailable, file search falls back to LIKE scans: {e}")
+        return
+    cursor.execute('''
+        CREATE TRIGGER files_fts_insert AFTER INSERT ON files BEGIN
+            INSERT INTO files_fts (rowid, filename) VALUES (new.id, new.filename);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER files_fts_delete AFTER DELETE ON files BEGIN
+            INSERT INTO files_fts (files_fts, rowid, filename) VALUES ('delete', old.id, old.filename);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER files_fts_update AFTER UPDATE OF filename ON files BEGIN
+            INSERT INTO files_fts (files_fts, rowid, filename) VALUES ('delete', old.id, old.filename);
+            INSERT INTO files_fts (rowid, filename) VALUES (new.id, new.filename);
+        END
+    ''')
+    # Index the files that predate the search index
+    cursor.execute("INSERT INTO files_fts (files_fts) VALUES ('rebuild')")
+
+def _migrate_analytics(cursor: sqlite3.Cursor):
+    """Append-only redemption log and its pre-aggregated rollups"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_stats_redemptions ON file_stats(redemptions)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS redemption_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts REAL NOT NULL,
+            user_id INTEGER NOT NULL,
+            access_code TEXT NOT NULL,
+            outcome TEXT NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_redemption_events_ts ON redemption_events(ts)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            redemptions INTEGER NOT NULL DEFAULT 0,
+            unique_users INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_redeemers (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE TABLE IF NOT EXISTS redeemers (user_id INTEGER PRIMARY KEY)")
+
+def _migrate_share_codes(cursor: sqlite3.Cursor):
+    """Which code each share came from, so repeat redemptions can find it"""
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(shared_files)")]
+    if 'access_code' not in columns:
+        cursor.execute("ALTER TABLE shared_files ADD COLUMN access_code TEXT")
+    # Covers find_share's ORDER BY delete_at as well as the lookup
+    cursor.execute("DROP INDEX IF EXISTS idx_shared_files_chat_code")
+    cursor.execute("CREATE INDEX idx_shared_files_chat_code ON shared_files(chat_id, access_code, delete_at)")
+
+def _migrate_hot_path_indexes(cursor: sqlite3.Cursor):
+    """Indexes for the startup and maintenance queries"""
+    cursor.execute("CREATE INDEX idx_pending_uploads_expires_at ON pending_uploads(expires_at)")
+    cursor.execute("CREATE INDEX idx_broadcasts_running ON broadcasts(id) WHERE status = 'running'")
+    cursor.execute("CREATE INDEX idx_counters_expires_at ON counters(expires_at) WHERE expires_at IS NOT NULL")
+    cursor.execute("CREATE INDEX idx_locks_expires_at ON locks(expires_at)")
+
+def _migrate_upload_files(cursor: sqlite3.Cursor):
+    """Bulk upload files as rows, so each document is an insert instead of a rewrite of the list"""
+    cursor.execute('''
+        CREATE TABLE pending_upload_files (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            entry TEXT NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX idx_pending_upload_files_user ON pending_upload_files(user_id, id)")
+
+def _migrate_user_count(cursor: sqlite3.Cursor):
+    """Running user count, so /stats and /check_users never scan the users table"""
+    cursor.execute("INSERT OR REPLACE INTO counters (key, value) SELECT 'users', COUNT(*) FROM users")
+
+SCHEMA_MIGRATIONS: List[Callable[[sqlite3.Cursor], None]] = [
+    _migrate_base_tables,
+    _migrate_background_jobs,
+    _migrate_counters_and_locks,
+    _migrate_catalog,
+    _migrate_analytics,
+    _migrate_share_codes,
+    _migrate_hot_path_indexes,
+    _migrate_upload_files,
+    _migrate_user_count,
+]
+
+class Storage(StateBackend):
+    """SQLite storage with long-lived WAL connections, executed off the event loop"""
+
+    def __init__(self, db_path: str, read_workers: int = 4, metrics: Metrics = None):
+        self.db_path = db_path
+        self.metrics = metrics
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        # Writes are serialized on one thread, reads fan out over a small pool
+        self.read_workers = read_workers
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="db-reader")
+        # Whether the files_fts index exists; SQLite builds without FTS5 fall back to LIKE
+        self._fts: Optional[bool] = None
+
+    def migrate(self) -> int:
+        """Apply pending SCHEMA_MIGRATIONS, each in its own transaction, and return the schema version"""
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version > len(SCHEMA_MIGRATIONS):
+                logger.warning(f"Database schema version {version} is newer than this build ({len(SCHEMA_MIGRATIONS)})")
+            for version, migration in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+                cursor = conn.cursor()
+                cursor.execute("BEGIN")
+                try:
+                    migration(cursor)
+                    cursor.execute(f"PRAGMA user_version = {version}")
+                    cursor.execute("COMMIT")
+                except Exception:
+                    cursor.execute("ROLLBACK")
+                    logger.error(f"Schema migration {version} ({migration.__doc__}) failed")
+                    raise
+                logger.info(f"Applied schema migration {version}: {migration.__doc__}")
+            return conn.execute("PRAGMA user_version").fetchone()[0]
+        finally:
+            conn.close()
+
+    async def warm_up(self):
+        """Open the writer and reader connections before the first update needs them"""
+        await asyncio.gather(
+            self.write(lambda conn: None),
+            *(self.read(lambda conn: conn.execute("SELECT 1").fetchone()) for _ in range(self.read_workers))
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection tuned for concurrent readers and a single writer"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    def _thread_connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _run_read(self, fn: Callable, args: tuple):
+        return fn(self._thread_connection(), *args)
+
+    def _run_write(self, fn: Callable, args: tuple):
+        conn = self._thread_connection()
+        with conn:
+            return fn(conn, *args)
+
+    async def _submit(self, op: str, executor: ThreadPoolExecutor, runner: Callable, fn: Callable, args: tuple):
+        loop = asyncio.get_running_loop()
+        if self.metrics is None:
+            return await loop.run_in_executor(executor, runner, fn, args)
+        # Timed on the loop side so queueing behind other statements is included
+        with self.metrics.time('db_duration_seconds', {'op': op}):
+            return await loop.run_in_executor(executor, runner, fn, args)
+
+    async def read(self, fn: Callable, *args):
+        """Run fn(conn, *args) on a reader thread"""
+        return await self._submit('read', self._readers, self._run_read, fn, args)
+
+    async def write(self, fn: Callable, *args):
+        """Run fn(conn, *args) inside a transaction on the writer thread"""
+        return await self._submit('write', self._writer, self._run_write, fn, args)
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """Execute one write statement and return the affected row count"""
+        return await self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql: str, rows: list) -> int:
+        return await self.write(lambda conn: conn.executemany(sql, rows).rowcount)
+
+    async def close(self):
+        """Refresh planner statistics, stop the worker threads and close every connection"""
+        try:
+            await self.write(lambda conn: conn.execute("PRAGMA optimize"))
+        except sqlite3.Error as e:
+            logger.warning(f"PRAGMA optimize failed: {e}")
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    # Repository API used by the handlers
+
+    async def add_users(self, rows: List[Tuple[int, Optional[str], Optional[str]]]) -> int:
+        """Insert (user_id, username, first_name) rows in one transaction, keeping the user count current"""
+        def insert(conn: sqlite3.Connection) -> int:
+            added = conn.executemany('''
+                INSERT OR IGNORE INTO users (user_id, username, first_name)
+                VALUES (?, ?, ?)
+            ''', rows).rowcount
+            if added:
+                conn.execute('''
+                    INSERT INTO counters (key, value) VALUES ('users', ?)
+                    ON CONFLICT(key) DO UPDATE SET value = value + excluded.value
+                ''', (added,))
+            return added
+        return await self.write(insert)
+
+    async def all_user_ids(self) -> List[int]:
+        rows = await self.fetchall("SELECT user_id FROM users")
+        return [user_id for (user_id,) in rows]
+
+    async def authorized_uploader_ids(self) -> List[int]:
+        rows = await self.fetchall("SELECT user_id FROM authorized_uploaders")
+        return [user_id for (user_id,) in rows]
+
+    async def get_file(self, access_code: str) -> Optional[Tuple[str, str]]:
+        return await self.fetchone("SELECT file_id, filename FROM files WHERE access_code = ?", (access_code,))
+
+    async def load_files(self, limit: int = -1) -> list:
+        """Return (access_code, file_id, filename) rows, newest first"""
+        return await self.fetchall(
+            "SELECT access_code, file_id, filename FROM files ORDER BY id DESC LIMIT ?", (limit,)
+        )
+
+    async def insert_files(self, rows: List[Tuple[str, str, int]], codes: List[str],
+                           new_code: Callable[[], str], max_attempts: int = 10) -> List[str]:
+        """Insert (file_id, filename, uploaded_by) rows in one transaction
+
+        Each row takes the next candidate from codes; on a UNIQUE collision a
+        fresh code from new_code() is tried instead. Returns the codes used.
+        """
+        def insert(conn: sqlite3.Connection) -> List[str]:
+            used = []
+            for (file_id, filename, uploaded_by), access_code in zip(rows, codes):
+                for _ in range(max_attempts):
+                    try:
+                        conn.execute('''
+                            INSERT INTO files (access_code, file_id, filename, uploaded_by)
+                            VALUES (?, ?, ?, ?)
+                        ''', (access_code, file_id, filename, uploaded_by))
+                        break
+                    except sqlite3.IntegrityError:
+                        access_code = new_code()
+                else:
+                    raise RuntimeError("Could not allocate a unique access code")
+                used.append(access_code)
+            return used
+        return await self.write(insert)
+
+    async def add_share(self, message_id: int, chat_id: int, file_id: str, delete_at: datetime,
+                        access_code: str = None) -> int:
+        def insert(conn: sqlite3.Connection) -> int:
+            return conn.execute('''
+                INSERT INTO shared_files (message_id, chat_id, file_id, delete_at, access_code)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (message_id, chat_id, file_id, delete_at, access_code)).lastrowid
+        return await self.write(insert)
+
+    async def find_share(self, chat_id: int, access_code: str, now: datetime) -> Optional[Tuple[int, int, datetime]]:
+        row = await self.fetchone('''
+            SELECT id, message_id, delete_at FROM shared_files
+            WHERE chat_id = ? AND access_code = ? AND delete_at > ?
+            ORDER BY delete_at DESC
+            LIMIT 1
+        ''', (chat_id, access_code, now))
+        return (row[0], row[1], datetime.fromisoformat(row[2])) if row else None
+
+    async def active_shares(self, now: datetime) -> list:
+        rows = await self.fetchall('''
+            SELECT id, message_id, chat_id, access_code, delete_at FROM shared_files
+            WHERE delete_at > ? AND access_code IS NOT NULL
+            ORDER BY delete_at
+        ''', (now,))
+        return [(*row[:4], datetime.fromisoformat(row[4])) for row in rows]
+
+    async def extend_share(self, share_id: int, delete_at: datetime) -> int:
+        return await self.execute("UPDATE shared_files SET delete_at = ? WHERE id = ?", (delete_at, share_id))
+
+    async def due_shares(self, now: datetime, limit: int) -> list:
+        """Return (id, message_id, chat_id) rows whose delete_at has passed"""
+        return await self.fetchall('''
+            SELECT id, message_id, chat_id FROM shared_files
+            WHERE delete_at <= ?
+            ORDER BY delete_at
+            LIMIT ?
+        ''', (now, limit))
+
+    async def remove_shares(self, share_ids: List[int]) -> int:
+        """Delete completed shared_files rows in a single transaction"""
+        return await self.executemany("DELETE FROM shared_files WHERE id = ?", [(share_id,) for share_id in share_ids])
+
+    async def count_shares(self) -> int:
+        row = await self.fetchone("SELECT COUNT(*) FROM shared_files")
+        return row[0]
+
+    async def count_users(self) -> int:
+        row = await self.fetchone("SELECT value FROM counters WHERE key = 'users'")
+        return row[0] if row else 0
+
+    async def user_ids_after(self, after_user_id: int, limit: int) -> List[int]:
+        """Return the next chunk of user ids in primary-key order"""
+        rows = await self.fetchall(
+            "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (after_user_id, limit)
+        )
+        return [user_id for (user_id,) in rows]
+
+    async def create_broadcast(self, text: str, status_chat_id: int, status_message_id: int) -> int:
+        def insert(conn: sqlite3.Connection) -> int:
+            cursor = conn.execute('''
+                INSERT INTO broadcasts (text, status_chat_id, status_message_id)
+                VALUES (?, ?, ?)
+            ''', (text, status_chat_id, status_message_id))
+            return cursor.lastrowid
+        return await self.write(insert)
+
+    async def save_broadcast_progress(self, broadcast_id: int, last_user_id: int, sent: int, failed: int,
+                                      status: str = 'running'):
+        await self.execute('''
+            UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, status = ?
+            WHERE id = ?
+        ''', (last_user_id, sent, failed, status, broadcast_id))
+
+    async def running_broadcasts(self) -> list:
+        return await self.fetchall('''
+            SELECT id, text, status_chat_id, status_message_id, last_user_id, sent, failed
+            FROM broadcasts WHERE status = 'running'
+        ''')
+
+    async def authorize_uploader(self, user_id: int, authorized_by: int) -> int:
+        return await self.execute('''
+            INSERT OR IGNORE INTO authorized_uploaders (user_id, authorized_by)
+            VALUES (?, ?)
+        ''', (user_id, authorized_by))
+
+    # Files collected by a bulk upload live in pending_upload_files, one row per document,
+    # after any written with the state itself (the files column)
+
+    async def save_upload_state(self, user_id: int, step: str, description: Optional[str],
+                                files: List[Tuple[str, str]], expires_at: float):
+        def save(conn: sqlite3.Connection):
+            conn.execute('''
+                INSERT OR REPLACE INTO pending_uploads (user_id, step, description, files, expires_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, step, description, json.dumps(files), expires_at))
+            conn.execute("DELETE FROM pending_upload_files WHERE user_id = ?", (user_id,))
+        await self.write(save)
+
+    async def append_upload_file(self, user_id: int, entry: Tuple[str, str], expires_at: float) -> bool:
+        def append(conn: sqlite3.Connection) -> bool:
+            if not conn.execute("UPDATE pending_uploads SET expires_at = ? WHERE user_id = ?",
+                                (expires_at, user_id)).rowcount:
+                return False
+            conn.execute("INSERT INTO pending_upload_files (user_id, entry) VALUES (?, ?)",
+                         (user_id, json.dumps(entry)))
+            return True
+        return await self.write(append)
+
+    @staticmethod
+    def _upload_row(conn: sqlite3.Connection, user_id: int) -> Optional[tuple]:
+        row = conn.execute(
+            "SELECT step, description, files, expires_at FROM pending_uploads WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        step, description, files, expires_at = row
+        entries = json.loads(files) + [json.loads(entry) for (entry,) in conn.execute(
+            "SELECT entry FROM pending_upload_files WHERE user_id = ? ORDER BY id", (user_id,)
+        )]
+        return step, description, [tuple(entry) for entry in entries], expires_at
+
+    async def get_upload_state(self, user_id: int) -> Optional[tuple]:
+        """Return (step, description, files, expires_at) for one user"""
+        return await self.read(self._upload_row, user_id)
+
+    async def pop_upload_state(self, user_id: int) -> Optional[tuple]:
+        def pop(conn: sqlite3.Connection) -> Optional[tuple]:
+            row = self._upload_row(conn, user_id)
+            self._delete_upload_state(conn, user_id)
+            return row
+        return await self.write(pop)
+
+    @staticmethod
+    def _delete_upload_state(conn: sqlite3.Connection, user_id: int):
+        conn.execute("DELETE FROM pending_uploads WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM pending_upload_files WHERE user_id = ?", (user_id,))
+
+    async def delete_upload_state(self, user_id: int):
+        await self.write(self._delete_upload_state, user_id)
+
+    async def load_upload_states(self, now: float) -> list:
+        """Drop expired rows and return the live ones, oldest first"""
+        def purge(conn: sqlite3.Connection):
+            conn.execute("DELETE FROM pending_uploads WHERE expires_at <= ?", (now,))
+            conn.execute("DELETE FROM pending_upload_files WHERE user_id NOT IN (SELECT user_id FROM pending_uploads)")
+        
+        def load(conn: sqlite3.Connection) -> list:
+            user_ids = [user_id for (user_id,) in conn.execute("SELECT user_id FROM pending_uploads ORDER BY expires_at")]
+            return [(user_id,) + self._upload_row(conn, user_id) for user_id in user_ids]
+        
+        await self.write(purge)
+        return await self.read(load)
+
+    async def revoke_uploader(self, user_id: int) -> int:
+        return await self.execute("DELETE FROM authorized_uploaders WHERE user_id = ?", (user_id,))
+
+    @staticmethod
+    def _fts_query(query: str) -> str:
+        """Quote each term as an FTS5 prefix match so user input is never parsed as syntax"""
+        return ' '.join('"' + term.replace('"', '""') + '"*' for term in query.split())
+
+    def _has_fts(self, conn: sqlite3.Connection) -> bool:
+        if self._fts is None:
+            self._fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'files_fts'").fetchone() is not None
+        return self._fts
+
+    async def list_files(self, before_id: int = None, limit: int = 20, uploaded_by: int = None,
+                         query: str = None) -> Tuple[list, Optional[int]]:
+        def page(conn: sqlite3.Connection) -> Tuple[list, Optional[int]]:
+            # Keyset pagination on the primary key: every page is an index range scan
+            joins, where, params = [], ["f.id < ?"], [before_id or 2 ** 63 - 1]
+            if uploaded_by is not None:
+                where.append("f.uploaded_by = ?")
+                params.append(uploaded_by)
+            if query and self._has_fts(conn):
+                joins.append("JOIN files_fts ON files_fts.rowid = f.id")
+                where.append("files_fts MATCH ?")
+                params.append(self._fts_query(query))
+            elif query:
+                where.append("f.filename LIKE ? ESCAPE '\\'")
+                params.append('%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+            rows = conn.execute(f'''
+                SELECT f.id, f.access_code, f.filename, f.upload_date, f.uploaded_by, COALESCE(s.redemptions, 0)
+                FROM files f {' '.join(joins)}
+                LEFT JOIN file_stats s ON s.access_code = f.access_code
+                WHERE {' AND '.join(where)}
+                ORDER BY f.id DESC
+                LIMIT ?
+            ''', (*params, limit + 1)).fetchall()
+            if len(rows) > limit:
+                return rows[:limit], rows[limit - 1][0]
+            return rows, None
+        return await self.read(page)
+
+    async def record_redemptions(self, events: List[Tuple[float, int, str, str]]):
+        def record(conn: sqlite3.Connection):
+            conn.executemany('''
+                INSERT INTO redemption_events (ts, user_id, access_code, outcome) VALUES (?, ?, ?, ?)
+            ''', events)
+            
+            # Fold the batch into per-code and per-day deltas before touching the aggregates
+            per_code: Dict[str, int] = {}
+            per_day: Dict[str, List[int]] = {}
+            new_users = 0
+            for ts, user_id, access_code, outcome in events:
+                if outcome != 'sent':
+                    continue
+                day = time.strftime('%Y-%m-%d', time.gmtime(ts))
+                per_code[access_code] = per_code.get(access_code, 0) + 1
+                totals = per_day.setdefault(day, [0, 0])
+                totals[0] += 1
+                totals[1] += conn.execute(
+                    "INSERT OR IGNORE INTO daily_redeemers (day, user_id) VALUES (?, ?)", (day, user_id)
+                ).rowcount
+                new_users += conn.execute("INSERT OR IGNORE INTO redeemers (user_id) VALUES (?)", (user_id,)).rowcount
+            if not per_code:
+                return
+            
+            conn.executemany('''
+                INSERT INTO file_stats (access_code, redemptions) VALUES (?, ?)
+                ON CONFLICT(access_code) DO UPDATE SET redemptions = redemptions + excluded.redemptions
+            ''', list(per_code.items()))
+            conn.executemany('''
+                INSERT INTO daily_stats (day, redemptions, unique_users) VALUES (?, ?, ?)
+                ON CONFLICT(day) DO UPDATE SET
+                    redemptions = redemptions + excluded.redemptions,
+                    unique_users = unique_users + excluded.unique_users
+            ''', [(day, redemptions, users) for day, (redemptions, users) in per_day.items()])
+            conn.executemany('''
+                INSERT INTO counters (key, value) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = value + excluded.value
+            ''', [('analytics:redemptions', sum(per_code.values())), ('analytics:redeemers', new_users)])
+        await self.write(record)
+
+    async def redemption_totals(self) -> Tuple[int, int]:
+        rows = dict(await self.fetchall(
+            "SELECT key, value FROM counters WHERE key IN ('analytics:redemptions', 'analytics:redeemers')"
+        ))
+        return rows.get('analytics:redemptions', 0), rows.get('analytics:redeemers', 0)
+
+    async def daily_stats(self, days: List[str]) -> List[Tuple[str, int, int]]:
+        rows = await self.fetchall(
+            f"SELECT day, redemptions, unique_users FROM daily_stats WHERE day IN ({','.join('?' * len(days))})",
+            tuple(days)
+        )
+        found = {day: (redemptions, users) for day, redemptions, users in rows}
+        return [(day, *found.get(day, (0, 0))) for day in days]
+
+    async def top_files(self, limit: int = 10) -> List[Tuple[str, Optional[str], int]]:
+        return await self.fetchall('''
+            SELECT s.access_code, f.filename, s.redemptions
+            FROM file_stats s LEFT JOIN files f ON f.access_code = s.access_code
+            ORDER BY s.redemptions DESC
+            LIMIT ?
+        ''', (limit,))
+
+    async def redemption_events(self, start: float, end: float, cursor=None, limit: int = 5000) -> Tuple[list, object]:
+        # Keyset on (ts, id) so every page is a range scan of idx_redemption_events_ts
+        after_ts, after_id = cursor or (start, 0)
+        rows = await self.fetchall('''
+            SELECT ts, id, user_id, access_code, outcome FROM redemption_events
+            WHERE (ts, id) > (?, ?) AND ts >= ? AND ts < ?
+            ORDER BY ts, id
+            LIMIT ?
+        ''', (after_ts, after_id, start, end, limit))
+        cursor = (rows[-1][0], rows[-1][1]) if len(rows) == limit else None
+        return [(ts, user_id, access_code, outcome) for ts, _, user_id, access_code, outcome in rows], cursor
+
+    async def incr_counter(self, key: str, amount: int = 1, ttl: float = None) -> int:
+        def incr(conn: sqlite3.Connection) -> int:
+            now = time.time()
+            conn.execute("DELETE FROM counters WHERE key = ? AND expires_at <= ?", (key, now))
+            return conn.execute('''
+                INSERT INTO counters (key, value, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = value + excluded.value
+                RETURNING value
+            ''', (key, amount, now + ttl if ttl else None)).fetchone()[0]
+        return await self.write(incr)
+
+    async def get_counter(self, key: str) -> int:
+        row = await self.fetchone(
+            "SELECT value FROM counters WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+        )
+        return row[0] if row else 0
+
+    async def counter_ttl(self, key: str) -> float:
+        now = time.time()
+        row = await self.fetchone("SELECT expires_at FROM counters WHERE key = ? AND expires_at > ?", (key, now))
+        return row[0] - now if row else 0.0
+
+    async def acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        def acquire(conn: sqlite3.Connection) -> bool:
+            now = time.time()
+            cursor = conn.execute('''
+                INSERT INTO locks (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE locks.owner = excluded.owner OR locks.expires_at <= ?
+            ''', (name, owner, now + ttl, now))
+            return cursor.rowcount > 0
+        return await self.write(acquire)
+
+    async def release_lock(self, name: str, owner: str):
+        await self.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+    async def purge_expired(self):
+        def purge(conn: sqlite3.Connection):
+            now = time.time()
+            conn.execute("DELETE FROM counters WHERE expires_at <= ?", (now,))
+            conn.execute("DELETE FROM locks WHERE expires_at <= ?", (now,))
+        await self.write(purge)
+
+class RedisBackend(StateBackend):
+    """Redis-backed state shared by every worker serving the same bot token
+
+    Files and shares are JSON strings created with SET NX, so access-code
+    uniqueness holds across workers without a transaction. Sorted sets give
+    the same orderings the SQLite indexes do: users by id for broadcast
+    cursors, files by insertion sequence (overall and per uploader) and
+    shares by delete_at. Redis has no full-text index, so a filename search
+    scans the catalog newest first, matching word prefixes as the FTS5 index
+    does, and stops after SEARCH_SCAN_LIMIT files, returning a cursor to
+    continue from.
+    """
+
+    shared = True
+    SEARCH_SCAN_LIMIT = 5000
+    # Upper bound on how long a redemption event can sit in a worker's buffer before it is appended
+    MAX_APPEND_DELAY = 600
+
+    def __init__(self, client, prefix: str = "filebot:", metrics: Metrics = None):
+        self.redis = client
+        self.prefix = prefix
+        self.metrics = None
+        if metrics is not None:
+            self.attach_metrics(metrics)
+
+    @classmethod
+    def from_url(cls, url: str, max_connections: int = 64, **kwargs) -> "RedisBackend":
+        if aioredis is None:
+            raise RuntimeError("STATE_BACKEND=redis needs the redis package: pip install 'redis>=5'")
+        # A blocking pool makes bursts wait for a connection instead of failing
+        pool = aioredis.BlockingConnectionPool.from_url(url, max_connections=max_connections, decode_responses=True)
+        return cls(aioredis.Redis(connection_pool=pool), **kwargs)
+
+    def attach_metrics(self, metrics: Metrics):
+        """Time every command and pipeline round trip into db_duration_seconds"""
+        self.metrics = metrics
+        client = self.redis
+        execute_command, pipeline = client.execute_command, client.pipeline
+
+        async def timed_command(*args, **options):
+            with metrics.time('db_duration_seconds', {'op': str(args[0]).lower()}):
+                return await execute_command(*args, **options)
+
+        def timed_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            async def timed_execute(*execute_args, **execute_kwargs):
+                with metrics.time('db_duration_seconds', {'op': 'pipeline'}):
+                    return await execute(*execute_args, **execute_kwargs)
+            pipe.execute = timed_execute
+            return pipe
+
+        # Every command method and scan_iter goes through execute_command, every batch through execute
+        client.execute_command = timed_command
+        client.pipeline = timed_pipeline
+
+    def _key(self, *parts) -> str:
+        return self.prefix + ':'.join(str(part) for part in parts)
+
+    @staticmethod
+    def _words(text: str) -> List[str]:
+        """Split text into words the way FTS5's unicode61 tokenizer does"""
+        return re.findall(r'[^\W_]+', text.casefold())
+
+    async def warm_up(self):
+        await self.redis.ping()
+
+    async def close(self):
+        await self.redis.aclose()
+
+    async def add_users(self, rows: List[Tuple[int, Optional[str], Optional[str]]]) -> int:
+        if not rows:
+            return 0
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id, username, first_name in rows:
+                pipe.zadd(self._key('users'), {user_id: user_id}, nx=True)
+                pipe.hsetnx(self._key('users', 'names'), user_id, json.dumps([username, first_name]))
+            results = await pipe.execute()
+        return sum(results[::2])
+
+    async def all_user_ids(self) -> List[int]:
+        return [int(user_id) for user_id in await self.redis.zrange(self._key('users'), 0, -1)]
+
+    async def count_users(self) -> int:
+        return await self.redis.zcard(self._key('users'))
+
+    async def user_ids_after(self, after_user_id: int, limit: int) -> List[int]:
+        users = await self.redis.zrangebyscore(self._key('users'), f"({after_user_id}", '+inf', start=0, num=limit)
+        return [int(user_id) for user_id in users]
+
+    async def get_file(self, access_code: str) -> Optional[Tuple[str, str]]:
+        value = await self.redis.get(self._key('file', access_code))
+        if value is None:
+            return None
+        entry = json.loads(value)
+        return entry['file_id'], entry['filename']
+
+    async def _files(self, codes: List[str]) -> list:
+        """Return (access_code, entry) pairs for the codes that still exist"""
+        if not codes:
+            return []
+        values = await self.redis.mget([self._key('file', code) for code in codes])
+        return [(code, json.loads(value)) for code, value in zip(codes, values) if value is not None]
+
+    async def load_files(self, limit: int = -1) -> list:
+        codes = await self.redis.zrevrange(self._key('files'), 0, limit - 1 if limit > 0 else -1)
+        return [(code, entry['file_id'], entry['filename']) for code, entry in await self._files(codes)]
+
+    async def insert_files(self, rows: List[Tuple[str, str, int]], codes: List[str],
+                           new_code: Callable[[], str], max_attempts: int = 10) -> List[str]:
+        used = []
+        upload_date = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        for (file_id, filename, uploaded_by), access_code in zip(rows, codes):
+            value = json.dumps({'file_id': file_id, 'filename': filename, 'uploaded_by': uploaded_by,
+                                'upload_date': upload_date})
+            for _ in range(max_attempts):
+                if await self.redis.set(self._key('file', access_code), value, nx=True):
+                    break
+                access_code = new_code()
+            else:
+                raise RuntimeError("Could not allocate a unique access code")
+            used.append(access_code)
+        
+        sequence = await self.redis.incrby(self._key('files', 'seq'), len(used))
+        if used:
+            first = sequence - len(used) + 1
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.zadd(self._key('files'), {code: first + i for i, code in enumerate(used)})
+                for i, (code, (_, _, uploaded_by)) in enumerate(zip(used, rows)):
+                    pipe.zadd(self._key('files', 'by', uploaded_by), {code: first + i})
+                await pipe.execute()
+        return used
+
+    async def list_files(self, before_id: int = None, limit: int = 20, uploaded_by: int = None,
+                         query: str = None) -> Tuple[list, Optional[int]]:
+        key = self._key('files', 'by', uploaded_by) if uploaded_by is not None else self._key('files')
+        terms = self._words(query) if query else []
+        upper = f"({before_id}" if before_id else '+inf'
+        matches, scanned, cursor = [], 0, None
+        while cursor is None:
+            batch = await self.redis.zrevrangebyscore(key, upper, '-inf', start=0, num=500 if terms else limit + 1,
+                                                      withscores=True)
+            if not batch:
+                break
+            entries = dict(await self._files([code for code, _ in batch]))
+            for code, score in batch:
+                entry = entries.get(code)
+                # Every term must start some word, like the AND of prefix terms the FTS5 index matches
+                if entry is None:
+                    continue
+                words = self._words(entry['filename']) if terms else []
+                if not all(any(word.startswith(term) for word in words) for term in terms):
+                    continue
+                if len(matches) == limit:
+                    cursor = matches[-1][0]
+                    break
+                matches.append((int(score), code, entry))
+            scanned += len(batch)
+            upper = f"({int(batch[-1][1])}"
+            if cursor is None and scanned >= self.SEARCH_SCAN_LIMIT:
+                cursor = int(batch[-1][1])
+        
+        counts = await self.redis.zmscore(self._key('file_stats'), [code for _, code, _ in matches]) if matches else []
+        rows = [(file_id, code, entry['filename'], entry['upload_date'], entry['uploaded_by'], int(count or 0))
+                for (file_id, code, entry), count in zip(matches, counts)]
+        return rows, cursor
+
+    async def record_redemptions(self, events: List[Tuple[float, int, str, str]]):
+        # Unique users are HyperLogLog estimates (about 0.8% error) rather than exact sets
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for ts, user_id, access_code, outcome in events:
+                pipe.xadd(self._key('redemptions'), {
+                    'ts': ts, 'user_id': user_id, 'access_code': access_code, 'outcome': outcome,
+                })
+                if outcome != 'sent':
+                    continue
+                day = time.strftime('%Y-%m-%d', time.gmtime(ts))
+                pipe.zincrby(self._key('file_stats'), 1, access_code)
+                pipe.hincrby(self._key('daily_stats'), day, 1)
+                pipe.pfadd(self._key('daily_redeemers', day), user_id)
+                pipe.pfadd(self._key('redeemers'), user_id)
+                pipe.incr(self._key('counter', 'analytics:redemptions'))
+            await pipe.execute()
+
+    async def redemption_totals(self) -> Tuple[int, int]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(self._key('counter', 'analytics:redemptions'))
+            pipe.pfcount(self._key('redeemers'))
+            redemptions, users = await pipe.execute()
+        return int(redemptions or 0), users
+
+    async def daily_stats(self, days: List[str]) -> List[Tuple[str, int, int]]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(self._key('daily_stats'), days)
+            for day in days:
+                pipe.pfcount(self._key('daily_redeemers', day))
+            counts, *users = await pipe.execute()
+        return [(day, int(count or 0), unique) for day, count, unique in zip(days, counts, users)]
+
+    async def top_files(self, limit: int = 10) -> List[Tuple[str, Optional[str], int]]:
+        top = await self.redis.zrevrange(self._key('file_stats'), 0, limit - 1, withscores=True)
+        entries = dict(await self._files([code for code, _ in top]))
+        return [(code, entries[code]['filename'] if code in entries else None, int(score)) for code, score in top]
+
+    async def redemption_events(self, start: float, end: float, cursor=None, limit: int = 5000) -> Tuple[list, object]:
+        # Stream ids are the server's millisecond append times, which trail the event ts by the
+        # write-behind delay. Scan ids up to MAX_APPEND_DELAY past end so late-flushed events are
+        # still found, and select the range exactly by ts.
+        lower = f"({cursor}" if cursor else str(int(start * 1000))
+        upper = str(math.ceil((end + self.MAX_APPEND_DELAY) * 1000) - 1)
+        entries = await self.redis.xrange(self._key('redemptions'), lower, upper, count=limit)
+        rows = [(float(event['ts']), int(event['user_id']), event['access_code'], event['outcome'])
+                for _, event in entries if start <= float(event['ts']) < end]
+        return rows, entries[-1][0] if len(entries) == limit else None
+
+    async def add_share(self, message_id: int, chat_id: int, file_id: str, delete_at: datetime,
+                        access_code: str = None) -> int:
+        share_id = await self.redis.incr(self._key('shares', 'seq'))
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(self._key('share', share_id), json.dumps([message_id, chat_id, file_id, access_code]))
+            pipe.zadd(self._key('shares'), {share_id: delete_at.timestamp()})
+            if access_code:
+                # (chat, code) -> newest share, expiring with it
+                pipe.set(self._key('share', 'by', chat_id, access_code), share_id,
+                         pxat=max(int(delete_at.timestamp() * 1000), 1))
+            await pipe.execute()
+        return share_id
+
+    async def find_share(self, chat_id: int, access_code: str, now: datetime) -> Optional[Tuple[int, int, datetime]]:
+        share_id = await self.redis.get(self._key('share', 'by', chat_id, access_code))
+        if share_id is None:
+            return None
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(self._key('share', share_id))
+            pipe.zscore(self._key('shares'), share_id)
+            value, delete_at = await pipe.execute()
+        if value is None or delete_at is None or delete_at <= now.timestamp():
+            return None
+        return int(share_id), json.loads(value)[0], datetime.fromtimestamp(delete_at)
+
+    async def active_shares(self, now: datetime) -> list:
+        entries = await self.redis.zrangebyscore(self._key('shares'), f"({now.timestamp()}", '+inf', withscores=True)
+        if not entries:
+            return []
+        values = await self.redis.mget([self._key('share', share_id) for share_id, _ in entries])
+        rows = []
+        for (share_id, delete_at), value in zip(entries, values):
+            if value is None:
+                continue
+            message_id, chat_id, _, *access_code = json.loads(value)
+            if access_code and access_code[0]:
+                rows.append((int(share_id), message_id, chat_id, access_code[0], datetime.fromtimestamp(delete_at)))
+        return rows
+
+    async def extend_share(self, share_id: int, delete_at: datetime) -> int:
+        value = await self.redis.get(self._key('share', share_id))
+        if value is None:
+            return 0
+        _, chat_id, _, *access_code = json.loads(value)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(self._key('shares'), {share_id: delete_at.timestamp()}, xx=True, ch=True)
+            if access_code and access_code[0]:
+                pipe.pexpireat(self._key('share', 'by', chat_id, access_code[0]), int(delete_at.timestamp() * 1000))
+            changed, *_ = await pipe.execute()
+        return changed
+
+    async def due_shares(self, now: datetime, limit: int) -> list:
+        share_ids = await self.redis.zrangebyscore(self._key('shares'), '-inf', now.timestamp(), start=0, num=limit)
+        if not share_ids:
+            return []
+        values = await self.redis.mget([self._key('share', share_id) for share_id in share_ids])
+        rows, orphans = [], []
+        for share_id, value in zip(share_ids, values):
+            if value is None:
+                orphans.append(share_id)
+                continue
+            message_id, chat_id = json.loads(value)[:2]
+            rows.append((int(share_id), message_id, chat_id))
+        if orphans:
+            await self.redis.zrem(self._key('shares'), *orphans)
+        return rows
+
+    async def remove_shares(self, share_ids: List[int]) -> int:
+        if not share_ids:
+            return 0
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self._key('shares'), *share_ids)
+            pipe.delete(*(self._key('share', share_id) for share_id in share_ids))
+            removed, _ = await pipe.execute()
+        return removed
+
+    async def count_shares(self) -> int:
+        return await self.redis.zcard(self._key('shares'))
+
+    async def create_broadcast(self, text: str, status_chat_id: int, status_message_id: int) -> int:
+        broadcast_id = await self.redis.incr(self._key('broadcasts', 'seq'))
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._key('broadcast', broadcast_id), mapping={
+                'text': text, 'status_chat_id': status_chat_id, 'status_message_id': status_message_id,
+                'last_user_id': 0, 'sent': 0, 'failed': 0, 'status': 'running',
+            })
+            pipe.sadd(self._key('broadcasts', 'running'), broadcast_id)
+            await pipe.execute()
+        return broadcast_id
+
+    async def save_broadcast_progress(self, broadcast_id: int, last_user_id: int, sent: int, failed: int,
+                                      status: str = 'running'):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._key('broadcast', broadcast_id), mapping={
+                'last_user_id': last_user_id, 'sent': sent, 'failed': failed, 'status': status,
+            })
+            if status != 'running':
+                pipe.srem(self._key('broadcasts', 'running'), broadcast_id)
+            await pipe.execute()
+
+    async def running_broadcasts(self) -> list:
+        broadcast_ids = sorted(int(broadcast_id) for broadcast_id in await self.redis.smembers(self._key('broadcasts', 'running')))
+        rows = []
+        for broadcast_id in broadcast_ids:
+            job = await self.redis.hgetall(self._key('broadcast', broadcast_id))
+            if job:
+                rows.append((broadcast_id, job['text'], int(job['status_chat_id']), int(job['status_message_id']),
+                             int(job['last_user_id']), int(job['sent']), int(job['failed'])))
+        return rows
+
+    async def authorized_uploader_ids(self) -> List[int]:
+        return [int(user_id) for user_id in await self.redis.hkeys(self._key('uploaders'))]
+
+    async def authorize_uploader(self, user_id: int, authorized_by: int) -> int:
+        return await self.redis.hsetnx(self._key('uploaders'), user_id, authorized_by)
+
+    async def revoke_uploader(self, user_id: int) -> int:
+        return await self.redis.hdel(self._key('uploaders'), user_id)
+
+    # Upload state is a [step, description] key plus a list of files, both expiring at
+    # expires_at, so each document is one RPUSH and abandoned sessions clean themselves up
+
+    def _upload_keys(self, user_id: int) -> Tuple[str, str]:
+        return self._key('upload', user_id), self._key('upload', user_id, 'files')
+
+    async def save_upload_state(self, user_id: int, step: str, description: Optional[str],
+                                files: List[Tuple[str, str]], expires_at: float):
+        state_key, files_key = self._upload_keys(user_id)
+        pxat = int(expires_at * 1000)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(state_key, json.dumps([step, description]), pxat=pxat)
+            pipe.delete(files_key)
+            if files:
+                pipe.rpush(files_key, *(json.dumps(entry) for entry in files))
+                pipe.pexpireat(files_key, pxat)
+            await pipe.execute()
+
+    async def append_upload_file(self, user_id: int, entry: Tuple[str, str], expires_at: float) -> bool:
+        state_key, files_key = self._upload_keys(user_id)
+        pxat = int(expires_at * 1000)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.pexpireat(state_key, pxat)
+            pipe.rpush(files_key, json.dumps(entry))
+            pipe.pexpireat(files_key, pxat)
+            extended, _, _ = await pipe.execute()
+        # Without a state key the entry went to an orphan list, which expires or is reset by the next save
+        return bool(extended)
+
+    async def _read_upload_state(self, user_id: int, delete: bool) -> Optional[tuple]:
+        state_key, files_key = self._upload_keys(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.get(state_key)
+            pipe.lrange(files_key, 0, -1)
+            pipe.pttl(state_key)
+            if delete:
+                pipe.delete(state_key, files_key)
+            value, entries, ttl = (await pipe.execute())[:3]
+        if value is None:
+            return None
+        step, description = json.loads(value)
+        return step, description, [tuple(json.loads(entry)) for entry in entries], time.time() + max(ttl, 0) / 1000
+
+    async def get_upload_state(self, user_id: int) -> Optional[tuple]:
+        return await self._read_upload_state(user_id, delete=False)
+
+    async def pop_upload_state(self, user_id: int) -> Optional[tuple]:
+        return await self._read_upload_state(user_id, delete=True)
+
+    async def delete_upload_state(self, user_id: int):
+        await self.redis.delete(*self._upload_keys(user_id))
+
+    async def load_upload_states(self, now: float) -> list:
+        rows = []
+        async for key in self.redis.scan_iter(match=self._key('upload', '*'), count=1000):
+            user_id = key[len(self._key('upload', '')):]
+            if user_id.isdigit():
+                state = await self.get_upload_state(int(user_id))
+                if state is not None:
+                    rows.append((int(user_id),) + state)
+        return sorted(rows, key=lambda row: row[4])
+
+    async def incr_counter(self, key: str, amount: int = 1, ttl: float = None) -> int:
+        key = self._key('counter', key)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if ttl:
+                # Creates the key with its expiry only if it is new; INCRBY keeps the TTL
+                pipe.set(key, 0, nx=True, px=max(int(ttl * 1000), 1))
+            pipe.incrby(key, amount)
+            results = await pipe.execute()
+        return results[-1]
+
+    async def get_counter(self, key: str) -> int:
+        value = await self.redis.get(self._key('counter', key))
+        return int(value) if value else 0
+
+    async def counter_ttl(self, key: str) -> float:
+        # PTTL is -2 for a missing key and -1 for one without an expiry
+        return max(await self.redis.pttl(self._key('counter', key)), 0) / 1000
+
+    async def acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        key = self._key('lock', name)
+        ttl_ms = max(int(ttl * 1000), 1)
+        if await self.redis.set(key, owner, nx=True, px=ttl_ms):
+            return True
+        return await self._if_owner(key, owner, lambda pipe: pipe.pexpire(key, ttl_ms))
+
+    async def release_lock(self, name: str, owner: str):
+        key = self._key('lock', name)
+        await self._if_owner(key, owner, lambda pipe: pipe.delete(key))
+
+    async def _if_owner(self, key: str, owner: str, command: Callable) -> bool:
+        """Queue command(pipe) in a transaction that only runs while owner holds key"""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                if await pipe.get(key) != owner:
+                    return False
+                pipe.multi()
+                command(pipe)
+                await pipe.execute()
+                return True
+            except aioredis.WatchError:
+                return False
+
+class AccessCodeCache:
+    """In-memory index of access codes kept coherent with the files table
+
+    With max_size=0 the whole catalog is held and a miss means the code does
+    not exist. With a positive max_size, or a backend other workers also write
+    to, the index is an LRU and misses fall back to the database.
+    """
+
+    def __init__(self, storage: StateBackend, max_size: int = 0):
+        self.storage = storage
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+        # True while every row of the files table is present in the index
+        self.complete = False
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, access_code: str) -> bool:
+        return access_code in self._entries
+
+    async def warm(self):
+        """Load the files table (or its newest max_size rows) into memory"""
+        limit = self.max_size + 1 if self.max_size else -1
+        rows = await self.storage.load_files(limit)
+        self._entries.clear()
+        # Rows arrive newest first; insert oldest first so LRU order matches recency
+        for access_code, file_id, filename in reversed(rows[:self.max_size or None]):
+            self._entries[access_code] = (file_id, filename)
+        self.complete = not self.storage.shared and (not self.max_size or len(rows) <= self.max_size)
+        logger.info(f"Access code cache warmed with {len(self._entries)} entries (complete={self.complete})")
+
+    async def get(self, access_code: str) -> Optional[Tuple[str, str]]:
+        """Return (file_id, filename) for a code, or None if it does not exist"""
+        entry = self._entries.get(access_code)
+        if entry is not None:
+            self.hits += 1
+            if self.max_size:
+                self._entries.move_to_end(access_code)
+            return entry
+        
+        self.misses += 1
+        if self.complete:
+            return None
+        
+        entry = await self.storage.get_file(access_code)
+        if entry:
+            self.put(access_code, *entry)
+        return entry
+
+    def put(self, access_code: str, file_id: str, filename: str):
+        """Write-through hook for newly inserted files"""
+        self._entries[access_code] = (file_id, filename)
+        self._entries.move_to_end(access_code)
+        if self.max_size and len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.complete = False
+
+    def discard(self, access_code: str):
+        """Write-through hook for deleted files"""
+        self._entries.pop(access_code, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, tokens: float = 1.0) -> bool:
+        """True if tokens could be taken now, without taking them"""
+        self._refill(time.monotonic())
+        return self.tokens >= tokens
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Take tokens if available without waiting"""
+        self._refill(time.monotonic())
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1.0):
+        """Wait until tokens are available, then take them"""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+class RateLimiter:
+    """In-memory flood protection for access-code redemption
+
+    Each user gets a token bucket, all users share a global bucket, and
+    repeated invalid codes trigger a lockout that doubles on every strike.
+    Invalid attempts are forgiven one per invalid_decay seconds rather than
+    on the next valid code, since codes are posted publicly and a valid one
+    is always at hand to reset a guessing run.
+    Users are kept in last-seen order so idle entries expire from the front
+    in amortized O(1), and max_users puts a hard bound on memory.
+    
+    Given a shared backend, allow() also enforces the per-user, global and
+    lockout limits with fixed-window counters every worker sees, so running
+    more workers does not multiply the limits.
+    """
+
+    class _UserState:
+        __slots__ = ('bucket', 'invalid', 'invalid_at', 'strikes', 'locked_until', 'seen', 'warned')
+
+        def __init__(self, bucket: TokenBucket, now: float):
+            self.bucket = bucket
+            self.invalid = 0.0
+            self.invalid_at = now
+            self.strikes = 0
+            self.locked_until = 0.0
+            self.seen = now
+            self.warned = False
+
+    def __init__(self, user_rate: float = 0.5, user_burst: float = 5, global_rate: float = 100,
+                 invalid_threshold: int = 5, invalid_decay: float = 180, lockout_base: float = 60,
+                 lockout_max: float = 3600, idle_ttl: float = 900, max_users: int = 200_000,
+                 backend: StateBackend = None):
+        self.backend = backend
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.invalid_threshold = invalid_threshold
+        self.invalid_decay = invalid_decay
+        self.lockout_base = lockout_base
+        self.lockout_max = lockout_max
+        self.idle_ttl = idle_ttl
+        self.max_users = max_users
+        self._global = TokenBucket(global_rate)
+        self._users: "OrderedDict[int, RateLimiter._UserState]" = OrderedDict()
+        self.rejected = 0
+
+    def _expire(self, now: float):
+        while self._users:
+            user_id, state = next(iter(self._users.items()))
+            idle = state.seen + self.idle_ttl <= now and state.locked_until <= now
+            if not idle and len(self._users) < self.max_users:
+                break
+            del self._users[user_id]
+
+    def _state(self, user_id: int, now: float) -> "RateLimiter._UserState":
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = self._UserState(TokenBucket(self.user_rate, self.user_burst), now)
+        else:
+            self._users.move_to_end(user_id)
+            state.seen = now
+        return state
+
+    def check(self, user_id: int) -> float:
+        """Return 0 if the request may proceed, else seconds until it may retry"""
+        now = time.monotonic()
+        self._expire(now)
+        state = self._state(user_id, now)
+        
+        # Neither bucket is charged for a request the other rejects
+        if state.locked_until > now:
+            retry_after = state.locked_until - now
+        elif not state.bucket.available():
+            retry_after = 1 / self.user_rate
+        elif not self._global.try_acquire():
+            retry_after = 1 / self._global.rate
+        else:
+            state.bucket.try_acquire()
+            state.warned = False
+            return 0.0
+        
+        self.rejected += 1
+        return retry_after
+
+    async def allow(self, user_id: int) -> float:
+        """check() plus the cross-worker limits when a shared backend is configured"""
+        retry_after = self.check(user_id)
+        if retry_after or self.backend is None:
+            return retry_after
+        
+        now = time.time()
+        window = self.user_burst / self.user_rate
+        lockout, user_count, global_count = await asyncio.gather(
+            self.backend.counter_ttl(f"lockout:{user_id}"),
+            self.backend.incr_counter(f"rate:{user_id}:{int(now // window)}", ttl=window),
+            self.backend.incr_counter(f"rate:global:{int(now)}", ttl=2),
+        )
+        if lockout:
+            retry_after = lockout
+        elif user_count > self.user_burst:
+            retry_after = window - now % window
+        elif global_count > self._global.rate:
+            retry_after = 1.0
+        else:
+            return 0.0
+        
+        self.rejected += 1
+        return retry_after
+
+    def should_warn(self, user_id: int) -> bool:
+        """True once per throttled streak, so a flood gets a single reply"""
+        state = self._users.get(user_id)
+        if state is None or state.warned:
+            return False
+        state.warned = True
+        return True
+
+    async def record_invalid(self, user_id: int):
+        """Count an invalid code, locking the user out after too many"""
+        now = time.monotonic()
+        state = self._state(user_id, now)
+        state.invalid = max(0.0, state.invalid - (now - state.invalid_at) / self.invalid_decay) + 1
+        state.invalid_at = now
+        # Partly forgiven attempts still count, so a quick run of invalid_threshold always locks
+        if state.invalid > self.invalid_threshold - 1:
+            state.invalid = 0.0
+            state.strikes += 1
+            lockout = min(self.lockout_base * 2 ** (state.strikes - 1), self.lockout_max)
+            state.locked_until = now + lockout
+            logger.warning(f"User {user_id} locked out for {lockout:.0f}s after repeated invalid codes")
+        
+        if self.backend is None:
+            return
+        # The same policy over counters shared by every worker; a fixed window as long as the
+        # local count takes to drain stands in for the decay
+        invalid = await self.backend.incr_counter(
+            f"invalid:{user_id}", ttl=self.invalid_decay * self.invalid_threshold
+        )
+        if invalid % self.invalid_threshold == 0:
+            strikes = await self.backend.incr_counter(f"strikes:{user_id}", ttl=self.lockout_max)
+            lockout = min(self.lockout_base * 2 ** (strikes - 1), self.lockout_max)
+            await self.backend.incr_counter(f"lockout:{user_id}", ttl=lockout)
+
+    def stats(self) -> dict:
+        return {'tracked_users': len(self._users), 'rejected': self.rejected}
+
+class MembershipCache:
+    """TTL cache for channel membership with single-flight lookups
+
+    Positive and negative results expire independently, and concurrent
+    lookups for the same user share one in-flight getChatMember request.
+    Failed lookups are never cached. Each result kind lives in its own
+    OrderedDict; with one TTL per dict, insertion order is expiry order, so
+    expiry and eviction only look at the fronts.
+    """
+
+    def __init__(self, positive_ttl: float = 300, negative_ttl: float = 15, max_entries: int = 100_000):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        # is_member -> {user_id: expires}
+        self._entries: Dict[bool, "OrderedDict[int, float]"] = {True: OrderedDict(), False: OrderedDict()}
+        self._inflight: Dict[int, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries[True]) + len(self._entries[False])
+
+    async def get(self, user_id: int, fetch: Callable[[], Awaitable[bool]]) -> bool:
+        """Return the cached membership for user_id, calling fetch() on a miss"""
+        now = time.monotonic()
+        for is_member, entries in self._entries.items():
+            expires = entries.get(user_id)
+            if expires is not None and expires > now:
+                self.hits += 1
+                return is_member
+        
+        self.misses += 1
+        future = self._inflight.get(user_id)
+        if future is None:
+            future = asyncio.ensure_future(self._load(user_id, fetch))
+            self._inflight[user_id] = future
+        # Shield so one cancelled waiter does not cancel the shared lookup
+        return await asyncio.shield(future)
+
+    async def _load(self, user_id: int, fetch: Callable[[], Awaitable[bool]]) -> bool:
+        try:
+            is_member = await fetch()
+            now = time.monotonic()
+            self.invalidate(user_id)
+            self._entries[is_member][user_id] = now + (self.positive_ttl if is_member else self.negative_ttl)
+            self._expire(now)
+            return is_member
+        finally:
+            del self._inflight[user_id]
+
+    def _expire(self, now: float):
+        """Drop expired entries, then the soonest to expire while over max_entries"""
+        for entries in self._entries.values():
+            while entries and next(iter(entries.values())) <= now:
+                entries.popitem(last=False)
+        while len(self) > self.max_entries:
+            fronts = [entries for entries in self._entries.values() if entries]
+            min(fronts, key=lambda entries: next(iter(entries.values()))).popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        for entries in self._entries.values():
+            entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {'entries': len(self), 'hits': self.hits, 'misses': self.misses}
+
+class DeletionScheduler:
+    """Sweeps due shared_files rows in batches and deletes their messages
+
+    The shared_files table is the only schedule, so pending deletions survive
+    restarts and no per-message jobs are kept in memory. Each sweep holds a
+    lease on the backend, so only one worker sweeps at a time.
+    """
+
+    LOCK_NAME = "deletion_sweeper"
+
+    def __init__(self, storage: StateBackend, batch_size: int = 200, concurrency: int = 10, rate: float = 25.0,
+                 owner: str = None, lock_ttl: float = 60, send_limiter: TokenBucket = None):
+        self.storage = storage
+        self.owner = owner or secrets.token_hex(8)
+        self.lock_ttl = lock_ttl
+        self.batch_size = batch_size
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # rate is this component's share; send_limiter is the bot-wide budget it draws from too
+        self._bucket = TokenBucket(rate)
+        self.send_limiter = send_limiter
+        self._lock = asyncio.Lock()
+        self._stopping = False
+        self.deleted = 0
+
+    async def sweep(self, bot: Bot) -> int:
+        """Delete every due message, returning the number of rows completed"""
+        if self._lock.locked():
+            return 0
+        
+        completed = 0
+        async with self._lock:
+            if not await self.storage.acquire_lock(self.LOCK_NAME, self.owner, self.lock_ttl):
+                return 0
+            try:
+                while True:
+                    rows = await self.storage.due_shares(datetime.now(), self.batch_size)
+                    if not rows:
+                        break
+                    
+                    results = await asyncio.gather(*(self._delete(bot, message_id, chat_id) for _, message_id, chat_id in rows))
+                    done = [share_id for (share_id, _, _), ok in zip(rows, results) if ok]
+                    if done:
+                        await self.storage.remove_shares(done)
+                        completed += len(done)
+                    
+                    # Deferred rows stay due; leave them for the next sweep
+                    if len(done) < len(rows) or self._stopping:
+                        break
+                    # Renew the lease per batch; if it lapsed another worker may have taken over
+                    if not await self.storage.acquire_lock(self.LOCK_NAME, self.owner, self.lock_ttl):
+                        break
+            finally:
+                await self.storage.release_lock(self.LOCK_NAME, self.owner)
+        
+        self.deleted += completed
+        if completed:
+            logger.info(f"Auto-deleted {completed} shared file messages")
+        return completed
+
+    def stop(self):
+        """Make a running sweep return after its current batch"""
+        self._stopping = True
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """Wait up to timeout for a running sweep to finish its batch"""
+        self.stop()
+        try:
+            await asyncio.wait_for(self._lock.acquire(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._lock.release()
+        return True
+
+    async def _delete(self, bot: Bot, message_id: int, chat_id: int) -> bool:
+        """Delete one message; False means retry on a later sweep"""
+        async with self._semaphore:
+            await self._bucket.acquire()
+            if self.send_limiter is not None:
+                await self.send_limiter.acquire()
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message_id)
+                return True
+            except RetryAfter as e:
+                logger.warning(f"Flood control while deleting messages, retry in {e.retry_after}s")
+                return False
+            except (BadRequest, Forbidden) as e:
+                # Already deleted, too old, or the user blocked the bot: nothing left to do
+                logger.debug(f"Dropping deletion of message {message_id} in chat {chat_id}: {e}")
+                return True
+            except NetworkError as e:
+                logger.warning(f"Network error deleting message {message_id}: {e}")
+                return False
+            except TelegramError as e:
+                logger.error(f"Error deleting message {message_id}: {e}")
+                return True
+
+class ActiveShareIndex:
+    """Index of files currently sitting in users' chats, keyed by (chat, code)
+
+    Lets a repeated redemption point at the copy already sent instead of
+    sending the document again. Entries live until their share's delete_at,
+    and since every share gets the same lifetime, insertion order is expiry
+    order. On a single node the index is warmed from the backend and a miss
+    is authoritative; on a shared backend misses are checked there, since the
+    share may have been sent by another worker.
+    """
+
+    def __init__(self, storage: StateBackend, max_size: int = 200_000):
+        self.storage = storage
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple[int, str], Tuple[int, int, float]]" = OrderedDict()
+        self._sending: Set[Tuple[int, str]] = set()
+        self.reused = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expire(self, now: float):
+        while self._entries:
+            key, (_, _, delete_at) = next(iter(self._entries.items()))
+            if delete_at > now and len(self._entries) <= self.max_size:
+                break
+            del self._entries[key]
+
+    async def load(self):
+        """Index the shares that are still pending deletion"""
+        for share_id, message_id, chat_id, access_code, delete_at in await self.storage.active_shares(datetime.now()):
+            self.add(chat_id, access_code, share_id, message_id, delete_at.timestamp())
+        logger.info(f"Indexed {len(self._entries)} active shares")
+
+    async def get(self, chat_id: int, access_code: str) -> Optional[Tuple[int, int, float]]:
+        """Return (share_id, message_id, delete_at) of the live share, if any"""
+        now = time.time()
+        entry = self._entries.get((chat_id, access_code))
+        if entry is not None and entry[2] > now:
+            return entry
+        if not self.storage.shared:
+            return None
+        
+        share = await self.storage.find_share(chat_id, access_code, datetime.fromtimestamp(now))
+        if share is None:
+            return None
+        share_id, message_id, delete_at = share
+        return self.add(chat_id, access_code, share_id, message_id, delete_at.timestamp())
+
+    def add(self, chat_id: int, access_code: str, share_id: int, message_id: int,
+            delete_at: float) -> Tuple[int, int, float]:
+        key = (chat_id, access_code)
+        entry = self._entries[key] = (share_id, message_id, delete_at)
+        self._entries.move_to_end(key)
+        self._expire(time.time())
+        return entry
+
+    def discard(self, chat_id: int, access_code: str):
+        self._entries.pop((chat_id, access_code), None)
+
+    def begin_send(self, chat_id: int, access_code: str) -> bool:
+        """Claim the first send of a code to a chat; False while one is already in flight"""
+        key = (chat_id, access_code)
+        if key in self._sending:
+            return False
+        self._sending.add(key)
+        return True
+
+    def end_send(self, chat_id: int, access_code: str):
+        self._sending.discard((chat_id, access_code))
+
+class BroadcastEngine:
+    """Background broadcast sender with rate limiting and resumable progress
+
+    Recipients are streamed from the users table in user_id order. After each
+    chunk the cursor and counters are saved to the broadcasts table, so a
+    restarted process resumes from the last completed chunk. Every job runs
+    under a per-broadcast lease renewed after each chunk, so with several
+    workers one sends it and the others adopt it only if that lease lapses.
+    """
+
+    def __init__(self, storage: StateBackend, rate: float = 25.0, concurrency: int = 20, chunk_size: int = 200,
+                 status_interval: float = 5.0, max_retries: int = 3, owner: str = None, lock_ttl: float = 60,
+                 send_limiter: TokenBucket = None):
+        self.storage = storage
+        self.owner = owner or secrets.token_hex(8)
+        self.lock_ttl = lock_ttl
+        self.chunk_size = chunk_size
+        # Status edits also go to a single chat, so keep them well under its 1 msg/s limit
+        self.status_interval = max(status_interval, 1.0)
+        self.max_retries = max_retries
+        # rate is this component's share; send_limiter is the bot-wide budget it draws from too
+        self._bucket = TokenBucket(rate)
+        self.send_limiter = send_limiter
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._paused_until = 0.0
+        self._tasks: Set[asyncio.Task] = set()
+        self._running: Set[int] = set()
+        self._stopping = False
+
+    async def start(self, bot: Bot, text: str, status_message) -> int:
+        """Persist a new broadcast job and start sending it in the background"""
+        broadcast_id = await self.storage.create_broadcast(text, status_message.chat_id, status_message.message_id)
+        self._spawn(bot, broadcast_id, text, status_message.chat_id, status_message.message_id, 0, 0, 0)
+        return broadcast_id
+
+    async def resume(self, bot: Bot):
+        """Adopt running broadcasts whose worker stopped or lost its lease"""
+        if self._stopping:
+            return
+        for row in await self.storage.running_broadcasts():
+            if row[0] not in self._running:
+                self._spawn(bot, *row)
+
+    async def join(self):
+        """Wait for every running broadcast to finish"""
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def stop(self, timeout: float = 0) -> int:
+        """Let running broadcasts save their current chunk, then cancel any still sending after timeout
+
+        Stopped broadcasts stay 'running' in storage and resume from their saved
+        cursor on restart. Returns the number that had to be cancelled.
+        """
+        self._stopping = True
+        pending = set(self._tasks)
+        if pending and timeout > 0:
+            _, pending = await asyncio.wait(pending, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        return len(pending)
+
+    def _spawn(self, bot: Bot, broadcast_id: int, *job):
+        self._running.add(broadcast_id)
+        task = asyncio.create_task(self._run(bot, broadcast_id, *job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(lambda _: self._running.discard(broadcast_id))
+
+    async def _run(self, bot: Bot, broadcast_id: int, text: str, status_chat_id: int, status_message_id: int,
+                   last_user_id: int, sent: int, failed: int):
+        lock_name = f"broadcast:{broadcast_id}"
+        if not await self.storage.acquire_lock(lock_name, self.owner, self.lock_ttl):
+            return
+        if last_user_id:
+            logger.info(f"Resuming broadcast {broadcast_id} after user {last_user_id}")
+        body = f"📢 **Broadcast Message:**\n\n{text}"
+        last_status = time.monotonic()
+        try:
+            while True:
+                users = await self.storage.user_ids_after(last_user_id, self.chunk_size)
+                if not users:
+                    break
+                
+                results = await asyncio.gather(*(self._send(bot, user_id, body) for user_id in users))
+                delivered = sum(results)
+                sent += delivered
+                failed += len(results) - delivered
+                last_user_id = users[-1]
+                await self.storage.save_broadcast_progress(broadcast_id, last_user_id, sent, failed)
+                if not await self.storage.acquire_lock(lock_name, self.owner, self.lock_ttl):
+                    logger.warning(f"Lost the lease on broadcast {broadcast_id}, leaving it to another worker")
+                    return
+                if self._stopping:
+                    logger.info(f"Pausing broadcast {broadcast_id} after user {last_user_id} for shutdown")
+                    return
+                
+                if time.monotonic() - last_status >= self.status_interval:
+                    last_status = time.monotonic()
+                    await self._edit_status(
+                        bot, status_chat_id, status_message_id,
+                        f"📤 **Broadcasting...**\n\n📤 Sent: {sent}\n❌ Failed: {failed}"
+                    )
+            
+            await self.storage.save_broadcast_progress(broadcast_id, last_user_id, sent, failed, status='done')
+            await self._edit_status(
+                bot, status_chat_id, status_message_id,
+                f"✅ **Broadcast Complete!**\n\n"
+                f"📤 Sent: {sent}\n"
+                f"❌ Failed: {failed}"
+            )
+            logger.info(f"Broadcast {broadcast_id} complete: {sent} sent, {failed} failed")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast {broadcast_id} stopped: {e}")
+        finally:
+            # Shielded so a cancelled job still hands its lease over promptly
+            await asyncio.shield(self.storage.release_lock(lock_name, self.owner))
+
+    async def _send(self, bot: Bot, user_id: int, body: str) -> bool:
+        async with self._semaphore:
+            for _ in range(self.max_retries):
+                delay = self._paused_until - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self._bucket.acquire()
+                if self.send_limiter is not None:
+                    await self.send_limiter.acquire()
+                try:
+                    await bot.send_message(chat_id=user_id, text=body, parse_mode='Markdown')
+                    return True
+                except RetryAfter as e:
+                    # Flood control applies to the whole bot, so pause every worker
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                except (BadRequest, Forbidden):
+                    return False
+                except TelegramError as e:
+                    logger.warning(f"Broadcast to {user_id} failed: {e}")
+            return False
+
+    async def _edit_status(self, bot: Bot, chat_id: int, message_id: int, text: str):
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, parse_mode='Markdown')
+        except TelegramError as e:
+            logger.warning(f"Could not update broadcast status: {e}")
+
+class CodeAllocator:
+    """Allocates access codes without probing the database
+
+    Codes are drawn from a CSPRNG over the 36^8 space and uniqueness is
+    enforced by the UNIQUE constraint on files.access_code, so an upload costs
+    a single insert and only the rare collision is retried.
+    """
+
+    ALPHABET = string.ascii_uppercase + string.digits
+    LENGTH = 8
+
+    def __init__(self, storage: StateBackend, code_cache: AccessCodeCache = None):
+        self.storage = storage
+        self.code_cache = code_cache
+
+    def generate(self) -> str:
+        """Return a random code not known to be taken"""
+        while True:
+            code = ''.join(secrets.choice(self.ALPHABET) for _ in range(self.LENGTH))
+            # Cheap local pre-check when the whole catalog is in memory
+            if self.code_cache is None or code not in self.code_cache:
+                return code
+
+    def generate_batch(self, count: int) -> List[str]:
+        """Pre-generate count distinct codes for a batch upload"""
+        codes: Dict[str, None] = {}
+        while len(codes) < count:
+            codes[self.generate()] = None
+        return list(codes)
+
+    async def insert_file(self, file_id: str, filename: str, uploaded_by: int) -> str:
+        """Store one file and return its access code"""
+        codes = await self.insert_files([(file_id, filename, uploaded_by)])
+        return codes[0]
+
+    async def insert_files(self, rows: List[Tuple[str, str, int]]) -> List[str]:
+        """Store (file_id, filename, uploaded_by) rows in one transaction and return their codes"""
+        return await self.storage.insert_files(rows, self.generate_batch(len(rows)), self.generate)
+
+class UploadState:
+    """Progress of one uploader through the /upload or /bulk_upload flow"""
+
+    __slots__ = ('step', 'description', 'files', 'expires_at')
+
+    def __init__(self, step: str, description: str = None, files: List[Tuple[str, str]] = None,
+                 expires_at: float = 0.0):
+        self.step = step
+        self.description = description
+        self.files = files if files is not None else []
+        self.expires_at = expires_at
+
+class UploadStateStore:
+    """Bounded, expiring store of in-flight upload conversations
+
+    Entries expire ttl seconds after their last change and the least recently
+    changed ones are evicted beyond max_size. Because every entry shares the
+    same TTL, insertion order is expiry order and cleanup only looks at the
+    front. With persist=True changes are written through to the
+    pending_uploads table so uploads in progress survive a restart.
+    
+    On a shared backend a user's next update may reach another worker, so
+    state is always written through and read back from the backend.
+    """
+
+    def __init__(self, storage: StateBackend, ttl: float = 1800, max_size: int = 10_000, persist: bool = True):
+        self.storage = storage
+        self.ttl = ttl
+        self.max_size = max_size
+        self.persist = persist or storage.shared
+        self._states: "OrderedDict[int, UploadState]" = OrderedDict()
+        self._deletes: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def _drop(self, user_id: int):
+        del self._states[user_id]
+        if self.persist:
+            # Called from synchronous expiry, so the delete runs in the background; stop() awaits it
+            task = asyncio.create_task(self.storage.delete_upload_state(user_id))
+            self._deletes.add(task)
+            task.add_done_callback(self._deletes.discard)
+
+    def _expire(self, now: float):
+        while self._states:
+            user_id, state = next(iter(self._states.items()))
+            if state.expires_at > now and len(self._states) <= self.max_size:
+                break
+            self._drop(user_id)
+
+    @staticmethod
+    def _from_row(row: Optional[tuple]) -> Optional[UploadState]:
+        if row is None or row[3] <= time.time():
+            return None
+        return UploadState(*row)
+
+    async def get(self, user_id: int) -> Optional[UploadState]:
+        if self.storage.shared:
+            return self._from_row(await self.storage.get_upload_state(user_id))
+        
+        state = self._states.get(user_id)
+        if state is not None and state.expires_at <= time.time():
+            self._drop(user_id)
+            return None
+        return state
+
+    async def save(self, user_id: int, state: UploadState):
+        """Store or refresh a user's state, extending its expiry"""
+        now = time.time()
+        state.expires_at = now + self.ttl
+        if not self.storage.shared:
+            self._states[user_id] = state
+            self._states.move_to_end(user_id)
+            self._expire(now)
+        if self.persist:
+            await self.storage.save_upload_state(user_id, state.step, state.description, state.files, state.expires_at)
+
+    async def append(self, user_id: int, state: UploadState, entry: Tuple[str, str]) -> bool:
+        """Add one file to a bulk upload, writing only that entry; False if the session has ended"""
+        now = time.time()
+        state.expires_at = now + self.ttl
+        if not self.storage.shared:
+            state.files.append(entry)
+            self._states[user_id] = state
+            self._states.move_to_end(user_id)
+            self._expire(now)
+        if self.persist:
+            appended = await self.storage.append_upload_file(user_id, entry, state.expires_at)
+            # Only the backend knows whether another worker closed a shared session meanwhile
+            if self.storage.shared:
+                return appended
+        return True
+
+    async def pop(self, user_id: int) -> Optional[UploadState]:
+        if self.storage.shared:
+            return self._from_row(await self.storage.pop_upload_state(user_id))
+        state = self._states.pop(user_id, None)
+        if self.persist and state is not None:
+            await self.storage.delete_upload_state(user_id)
+        return state
+
+    async def load(self):
+        """Restore uploads that were in progress before a restart"""
+        if not self.persist or self.storage.shared:
+            return
+        for user_id, step, description, files, expires_at in await self.storage.load_upload_states(time.time()):
+            self._states[user_id] = UploadState(step, description, files, expires_at)
+        logger.info(f"Restored {len(self._states)} pending uploads")
+
+    async def stop(self):
+        """Wait for background deletes of expired states"""
+        await asyncio.gather(*self._deletes, return_exceptions=True)
+
+class BloomFilter:
+    """Fixed-size Bloom filter over integer ids"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: int):
+        digest = hashlib.blake2b(item.to_bytes(8, 'little', signed=True), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: int):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: int) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+class WriteBehindBuffer:
+    """Background flush loop shared by the write-behind components
+
+    Subclasses queue work in memory and implement flush(). The loop flushes
+    every flush_interval seconds or as soon as wake() is called. stop() asks
+    the loop to exit after the flush it is running, instead of cancelling it,
+    so a batch already taken off the queue is always written or put back.
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        raise NotImplementedError
+
+    async def stop(self):
+        """Let the loop finish its current flush, then write out anything still queued"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            # Shielded so a caller's timeout cannot cancel a flush halfway through
+            await asyncio.shield(self._task)
+            self._task = None
+        await self.flush()
+
+class UserRegistry(WriteBehindBuffer):
+    """Write-behind registration of users seen via /start
+
+    Known user ids are kept in memory so a repeat /start costs nothing. The
+    set switches to a Bloom filter above bloom_threshold ids; a false positive
+    there only means an occasional new user is not recorded. New users are
+    queued and written with executemany once batch_size rows are waiting or
+    flush_interval seconds have passed, and flush() drains the queue at
+    shutdown.
+    """
+
+    def __init__(self, storage: StateBackend, batch_size: int = 500, flush_interval: float = 2.0,
+                 bloom_threshold: int = 1_000_000, bloom_error_rate: float = 0.001):
+        super().__init__(flush_interval)
+        self.storage = storage
+        self.batch_size = batch_size
+        self.bloom_threshold = bloom_threshold
+        self.bloom_error_rate = bloom_error_rate
+        self._known = set()
+        self._known_count = 0
+        self._pending: Dict[int, Tuple[int, Optional[str], Optional[str]]] = {}
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def _remember(self, user_id: int):
+        self._known.add(user_id)
+        self._known_count += 1
+        if isinstance(self._known, set) and self._known_count > self.bloom_threshold:
+            # Size for twice the current population so the error rate holds while it grows
+            bloom = BloomFilter(self._known_count * 2, self.bloom_error_rate)
+            for known_id in self._known:
+                bloom.add(known_id)
+            self._known = bloom
+            logger.info(f"User registry switched to a Bloom filter at {self._known_count} users")
+
+    async def load(self):
+        """Populate the seen-set from the users table"""
+        for user_id in await self.storage.all_user_ids():
+            self._remember(user_id)
+        logger.info(f"User registry loaded {self._known_count} users")
+
+    def add(self, user_id: int, username: str = None, first_name: str = None):
+        """Queue a user for insertion unless already known"""
+        if user_id in self._known:
+            return
+        self._remember(user_id)
+        self._pending[user_id] = (user_id, username, first_name)
+        if len(self._pending) >= self.batch_size:
+            self.wake()
+
+    async def flush(self):
+        """Write every queued user in a single transaction"""
+        if not self._pending:
+            return
+        rows = list(self._pending.values())
+        self._pending.clear()
+        try:
+            await self.storage.add_users(rows)
+        except asyncio.CancelledError:
+            self._requeue(rows)
+            raise
+        except Exception as e:
+            # Put the rows back so the next flush retries them
+            logger.error(f"Failed to flush {len(rows)} users: {e}")
+            self._requeue(rows)
+
+    def _requeue(self, rows: List[Tuple[int, Optional[str], Optional[str]]]):
+        for row in rows:
+            self._pending.setdefault(row[0], row)
+
+class RedemptionAnalytics(WriteBehindBuffer):
+    """Write-behind log of redemption attempts with pre-aggregated counters
+
+    Handlers only append to an in-memory buffer. Every flush_interval
+    seconds, or once batch_size events are waiting, the buffer is written as
+    one batch that appends to the event log and bumps the per-code, per-day
+    and unique-user counters, so stats never need a scan of the log. If the
+    backend is unreachable the buffer is kept up to max_pending events and
+    the oldest are dropped beyond that.
+    """
+
+    def __init__(self, storage: StateBackend, flush_interval: float = 5.0, batch_size: int = 1000,
+                 max_pending: int = 100_000):
+        super().__init__(flush_interval)
+        self.storage = storage
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._events: List[Tuple[float, int, str, str]] = []
+        self._sent: Dict[str, int] = {}
+        self.dropped = 0
+
+    def pending_count(self) -> int:
+        return len(self._events)
+
+    def record(self, user_id: int, access_code: str, outcome: str):
+        self._events.append((time.time(), user_id, access_code, outcome))
+        if outcome == 'sent':
+            self._sent[access_code] = self._sent.get(access_code, 0) + 1
+        if len(self._events) >= self.batch_size:
+            self.wake()
+
+    def pending(self, access_code: str) -> int:
+        """Redemptions of access_code not yet written to the backend"""
+        return self._sent.get(access_code, 0)
+
+    async def flush(self):
+        if not self._events:
+            return
+        events, sent = self._events, self._sent
+        self._events, self._sent = [], {}
+        try:
+            await self.storage.record_redemptions(events)
+        except asyncio.CancelledError:
+            self._requeue(events, sent)
+            raise
+        except Exception as e:
+            logger.error(f"Failed to flush {len(events)} redemption events: {e}")
+            self._requeue(events, sent)
+
+    def _requeue(self, events: List[Tuple[float, int, str, str]], sent: Dict[str, int]):
+        """Keep a failed batch ahead of anything recorded meanwhile, within the memory bound"""
+        self._events = events + self._events
+        for access_code, count in sent.items():
+            self._sent[access_code] = self._sent.get(access_code, 0) + count
+        overflow = len(self._events) - self.max_pending
+        if overflow > 0:
+            for _, _, access_code, outcome in self._events[:overflow]:
+                if outcome == 'sent':
+                    self._sent[access_code] -= 1
+            del self._events[:overflow]
+            self.dropped += overflow
+            logger.warning(f"Dropped {overflow} redemption events while the backend was unavailable")
+
+class AuthorizationService:
+    """In-memory view of the owner and authorized uploaders
+
+    The authorized_uploaders table is loaded once at startup and every change
+    is committed to the database before the set is updated, so permission
+    checks are pure memory lookups. On a shared backend the set is reloaded
+    periodically to pick up changes made through other workers.
+    """
+
+    def __init__(self, storage: StateBackend, owner_id: int):
+        self.storage = storage
+        self.owner_id = owner_id
+        self._uploaders: Set[int] = set()
+
+    async def load(self):
+        self._uploaders = set(await self.storage.authorized_uploader_ids())
+        logger.debug(f"Loaded {len(self._uploaders)} authorized uploaders")
+
+    def is_owner(self, user_id: int) -> bool:
+        return user_id == self.owner_id
+
+    def is_uploader(self, user_id: int) -> bool:
+        return user_id == self.owner_id or user_id in self._uploaders
+
+    async def authorize(self, user_id: int, authorized_by: int) -> bool:
+        """Grant upload permission; False if the user already had it"""
+        added = await self.storage.authorize_uploader(user_id, authorized_by)
+        self._uploaders.add(user_id)
+        return added > 0
+
+    async def revoke(self, user_id: int) -> bool:
+        """Withdraw upload permission; False if the user did not have it"""
+        removed = await self.storage.revoke_uploader(user_id)
+        self._uploaders.discard(user_id)
+        return removed > 0
+
+def owner_only(handler: Callable) -> Callable:
+    """Restrict a FileAccessBot handler to the bot owner"""
+    @wraps(handler)
+    async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not self.auth.is_owner(update.effective_user.id):
+            if update.callback_query is not None:
+                await update.callback_query.answer("❌ This command is for the owner only.")
+            else:
+                await update.message.reply_text("❌ This command is for the owner only.")
+            return
+        return await handler(self, update, context)
+    return wrapper
+
+def uploader_only(handler: Callable) -> Callable:
+    """Restrict a FileAccessBot handler to the owner and authorized uploaders"""
+    @wraps(handler)
+    async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not self.auth.is_uploader(update.effective_user.id):
+            await update.message.reply_text("❌ You are not authorized to upload files.")
+            return
+        return await handler(self, update, context)
+    return wrapper
+
+# Telegram rejects messages longer than this many characters
+MAX_MESSAGE_LENGTH = 4096
+
+def split_message(blocks: List[str], limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Join text blocks into as few messages as fit under limit, never splitting a block"""
+    chunks, current = [], ""
+    for block in blocks:
+        block = block[:limit]
+        if current and len(current) + len(block) > limit:
+            chunks.append(current)
+            current = ""
+        current += block
+    if current:
+        chunks.append(current)
+    return chunks
+
+# (status, content type, body) returned by HttpServer route handlers
+HttpResponse = Tuple[int, str, bytes]
+
+class HttpServer:
+    """Minimal asyncio HTTP/1.1 server for the webhook and probe endpoints"""
+
+    def __init__(self, host: str, port: int, max_body: int = 1 << 20, idle_timeout: float = 60):
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.idle_timeout = idle_timeout
+        self.routes: Dict[Tuple[str, str], Callable[[Dict[str, str], bytes], Awaitable[HttpResponse]]] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def route(self, method: str, path: str, handler: Callable[[Dict[str, str], bytes], Awaitable[HttpResponse]]):
+        self.routes[(method, path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"HTTP server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Keep-alive loop: Telegram reuses connections for webhook deliveries
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                # Headers and body get the same deadline, so a slow client cannot hold the connection
+                headers = await asyncio.wait_for(self._read_headers(reader), self.idle_timeout)
+                
+                length = int(headers.get('content-length', '0'))
+                if length > self.max_body:
+                    await self._respond(writer, (413, 'text/plain', b'payload too large'), keep_alive=False)
+                    break
+                body = await asyncio.wait_for(reader.readexactly(length), self.idle_timeout) if length else b''
+                
+                handler = self.routes.get((method, target.split('?', 1)[0]))
+                if handler is None:
+                    response = (404, 'text/plain', b'not found')
+                else:
+                    try:
+                        response = await handler(headers, body)
+                    except Exception as e:
+                        logger.error(f"HTTP handler error for {method} {target}: {e}")
+                        response = (500, 'text/plain', b'internal error')
+                
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_headers(reader: asyncio.StreamReader) -> Dict[str, str]:
+        headers: Dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    async def _respond(self, writer: asyncio.StreamWriter, response: HttpResponse, keep_alive: bool):
+        status, content_type, body = response
+        head = (
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    """Dispatches updates through per-class lanes so one kind of traffic cannot starve another
+
+    classify maps each update to a lane. Every lane has its own worker limit
+    and a bounded number of waiting updates; once a lane's queue is full its
+    new updates are shed through on_shed instead of queueing behind the
+    backlog. The application-wide limit is sized so it never blocks before a
+    lane does, which would put every class back into one queue.
+    
+    Replies to shed updates share a token bucket and go to each sender
+    (shed_key) at most once per streak of shed updates, so a flood cannot
+    turn into a flood of replies; the rest are shed silently.
+    """
+
+    class _Lane:
+        __slots__ = ('semaphore', 'concurrency', 'queue_limit', 'waiting', 'active', 'shed')
+
+        def __init__(self, concurrency: int, queue_limit: int):
+            self.semaphore = asyncio.Semaphore(concurrency)
+            self.concurrency = concurrency
+            self.queue_limit = queue_limit
+            self.waiting = 0
+            self.active = 0
+            self.shed = 0
+
+    def __init__(self, lanes: Dict[str, Tuple[int, int]], classify: Callable[[object], str],
+                 on_shed: Callable[[object, str], Awaitable[None]] = None, max_shed_replies: int = 32,
+                 shed_reply_rate: float = 5, shed_key: Callable[[object], object] = None,
+                 max_warned: int = 100_000, metrics: Metrics = None):
+        if not lanes or min(concurrency for concurrency, _ in lanes.values()) < 1:
+            raise ValueError("Every dispatch lane needs a concurrency of at least 1")
+        super().__init__(sum(concurrency + queue_limit for concurrency, queue_limit in lanes.values()) + max_shed_replies)
+        self.lanes = {name: self._Lane(*limits) for name, limits in lanes.items()}
+        self.classify = classify
+        self.on_shed = on_shed
+        self.shed_key = shed_key
+        self.max_warned = max_warned
+        self.metrics = metrics or Metrics()
+        # Busy replies are best effort: when too many are in flight, shed silently
+        self._shed_replies = asyncio.Semaphore(max_shed_replies)
+        self._shed_bucket = TokenBucket(shed_reply_rate)
+        # Senders already told during their current shed streak, oldest first
+        self._warned: "OrderedDict[object, None]" = OrderedDict()
+
+    def _should_reply(self, update: object) -> bool:
+        """True if a shed update may get a busy reply, like RateLimiter.should_warn"""
+        if self.on_shed is None or self._shed_replies.locked():
+            return False
+        key = self.shed_key(update) if self.shed_key is not None else None
+        if key is not None and key in self._warned:
+            return False
+        if not self._shed_bucket.try_acquire():
+            return False
+        if key is not None:
+            self._warned[key] = None
+            if len(self._warned) > self.max_warned:
+                self._warned.popitem(last=False)
+        return True
+
+    async def do_process_update(self, update: object, coroutine: Awaitable):
+        name = self.classify(update)
+        lane = self.lanes[name]
+        if lane.semaphore.locked() and lane.waiting >= lane.queue_limit:
+            # The coroutine is Application.process_update(update); it never started
+            coroutine.close()
+            lane.shed += 1
+            self.metrics.inc('shed_updates_total', {'lane': name})
+            if self._should_reply(update):
+                async with self._shed_replies:
+                    await self.on_shed(update, name)
+            return
+        
+        if self._warned:
+            # An admitted update ends the sender's shed streak
+            self._warned.pop(self.shed_key(update), None)
+        lane.waiting += 1
+        queued = time.perf_counter()
+        try:
+            await lane.semaphore.acquire()
+        finally:
+            lane.waiting -= 1
+        self.metrics.observe('dispatch_wait_seconds', time.perf_counter() - queued, {'lane': name})
+        lane.active += 1
+        try:
+            await coroutine
+        finally:
+            lane.active -= 1
+            lane.semaphore.release()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            name: {'active': lane.active, 'waiting': lane.waiting, 'shed': lane.shed}
+            for name, lane in self.lanes.items()
+        }
 
 class FileAccessBot:
-    def __init__(self, bot_token: str, owner_id: int, backup_channel_id: str):
+    # Bulk uploads larger than this get their codes as a CSV document
+    BULK_INLINE_LIMIT = 25
+    BULK_MAX_FILES = 2000
+    FILES_PAGE_SIZE = 20
+    EXPORT_MAX_ROWS = 500_000
+    # Shared files are deleted after this long
+    SHARE_TTL = timedelta(minutes=15)
+    # A share this close to deletion is sent again rather than pointed at
+    SHARE_REUSE_MARGIN = 60
+    
+    def __init__(self, bot_token: str, owner_id: int, backup_channel_id: str, storage: StateBackend = None):
         logger.info(f"Initializing bot with owner_id: {owner_id}, channel: {backup_channel_id}")
-        self.BOT_TOKEN = os.getenv("7559492905:AAFEtoyWTIB0l83RFw2fZOhp3bU9geVTTpA")
-        self.owner_id = os.getenv("5045767844")
-        self.backup_channel_id = os.getenv("@newupji")
+        self.bot_token = bot_token
+        self.owner_id = owner_id
+        self.backup_channel_id = backup_channel_id
         self.db_path = "file_bot.db"
-        logger.info("Initializing database...")
-        self.init_database()
-        logger.info("Database initialized successfully")
+        
+        # Serving mode: "polling" (default) or "webhook"
+        self.mode = os.getenv("BOT_MODE", "polling")
+        # Workers for ordinary user traffic; owner, uploader and callback updates get their own pools
+        self.concurrent_updates = int(os.getenv("CONCURRENT_UPDATES", "64"))
+        self.webhook_path = os.getenv("WEBHOOK_PATH", "/telegram")
+        base_url = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL", "")
+        self.webhook_url = base_url.rstrip('/') + self.webhook_path
+        self.webhook_secret = os.getenv("WEBHOOK_SECRET")
+        # Render injects PORT for web services; the probe endpoints are served whenever it is set
+        port = os.getenv("PORT")
+        self.http_server = HttpServer("0.0.0.0", int(port or 8080)) if port or self.mode == "webhook" else None
+        self.ready = False
+        self.draining = False
+        # Render sends SIGKILL 30s after SIGTERM; finish draining comfortably before that
+        self.shutdown_timeout = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))
+        self._drain_deadline = 0.0
+        # Identifies this worker as the holder of sweeper and broadcast leases
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self.metrics = Metrics()
+        
+        # State backend: "sqlite" for a single worker, "redis" to share state between workers
+        self.state_backend = os.getenv("STATE_BACKEND", "sqlite")
+        if storage is not None:
+            self.storage = storage
+        elif self.state_backend == "redis":
+            self.storage = RedisBackend.from_url(
+                os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+                max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", "64")),
+                prefix=os.getenv("REDIS_PREFIX", "filebot:"),
+                metrics=self.metrics
+            )
+        else:
+            self.storage = Storage(self.db_path, metrics=self.metrics)
+            logger.info(f"Database schema at version {self.storage.migrate()}")
+        self.auth = AuthorizationService(self.storage, self.owner_id)
+        self.user_registry = UserRegistry(
+            self.storage,
+            batch_size=int(os.getenv("USER_FLUSH_BATCH", "500")),
+            flush_interval=float(os.getenv("USER_FLUSH_INTERVAL", "2"))
+        )
+        self.code_cache = AccessCodeCache(self.storage, max_size=int(os.getenv("ACCESS_CODE_CACHE_SIZE", "0")))
+        self.code_allocator = CodeAllocator(self.storage, self.code_cache)
+        self.analytics = RedemptionAnalytics(
+            self.storage, flush_interval=float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "5"))
+        )
+        self.active_shares = ActiveShareIndex(self.storage)
+        # Restart the 15-minute timer when a user redeems a code they already have open
+        self.extend_repeat_shares = os.getenv("EXTEND_REPEAT_SHARES", "0") == "1"
+        # One budget for every message this process sends, kept under Telegram's ~30 msg/s per bot;
+        # broadcasts and deletions also have their own lower sub-limits
+        self.send_limiter = TokenBucket(float(os.getenv("SEND_RATE", "28")))
+        self.deletion_scheduler = DeletionScheduler(
+            self.storage,
+            rate=float(os.getenv("DELETION_RATE", "25")),
+            owner=self.instance_id,
+            send_limiter=self.send_limiter
+        )
+        self.broadcast_engine = BroadcastEngine(
+            self.storage,
+            rate=float(os.getenv("BROADCAST_RATE", "25")),
+            concurrency=int(os.getenv("BROADCAST_CONCURRENCY", "20")),
+            owner=self.instance_id,
+            send_limiter=self.send_limiter
+        )
+        self.rate_limiter = RateLimiter(
+            user_rate=float(os.getenv("USER_RATE_LIMIT", "0.5")),
+            user_burst=float(os.getenv("USER_RATE_BURST", "5")),
+            global_rate=float(os.getenv("GLOBAL_RATE_LIMIT", "100")),
+            backend=self.storage if self.storage.shared else None
+        )
+        self.membership_cache = MembershipCache(
+            positive_ttl=float(os.getenv("MEMBERSHIP_POSITIVE_TTL", "300")),
+            negative_ttl=float(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "15")),
+        )
         
         # In-memory storage for temporary data
-        self.pending_uploads: Dict[int, dict] = {}
-        self.uploaded_users: Set[int] = set()
+        self.pending_uploads = UploadStateStore(
+            self.storage,
+            ttl=float(os.getenv("UPLOAD_STATE_TTL", "1800")),
+            max_size=int(os.getenv("UPLOAD_STATE_MAX", "10000")),
+            persist=os.getenv("PERSIST_UPLOAD_STATE", "1") == "1"
+        )
         
-    def init_database(self):
-        """Initialize SQLite database"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Users table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    joined_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Files table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS files (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    access_code TEXT UNIQUE NOT NULL,
-                    file_id TEXT NOT NULL,
-                    filename TEXT NOT NULL,
-                    uploaded_by INTEGER NOT NULL,
-                    upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Authorized uploaders table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS authorized_uploaders (
-                    user_id INTEGER PRIMARY KEY,
-                    authorized_by INTEGER NOT NULL,
-                    authorized_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Shared files tracking (for auto-deletion)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS shared_files (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    message_id INTEGER NOT NULL,
-                    chat_id INTEGER NOT NULL,
-                    file_id TEXT NOT NULL,
-                    shared_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    delete_at TIMESTAMP NOT NULL
-                )
-            ''')
-            
-            conn.commit()
-            conn.close()
-            logger.info("Database tables created successfully")
-        except Exception as e:
-            logger.error(f"Database initialization error: {e}")
-            raise
+        # Lane: (workers, updates allowed to wait before new ones are shed)
+        self.update_processor = PriorityUpdateProcessor(
+            {
+                'owner': (int(os.getenv("OWNER_CONCURRENCY", "8")), int(os.getenv("OWNER_QUEUE_LIMIT", "1000"))),
+                'uploads': (int(os.getenv("UPLOAD_CONCURRENCY", "32")), int(os.getenv("UPLOAD_QUEUE_LIMIT", "1000"))),
+                'callbacks': (int(os.getenv("CALLBACK_CONCURRENCY", "16")), int(os.getenv("CALLBACK_QUEUE_LIMIT", "200"))),
+                'redemptions': (self.concurrent_updates, int(os.getenv("REDEMPTION_QUEUE_LIMIT", "500"))),
+            },
+            classify=self.classify_update,
+            on_shed=self.reply_busy,
+            shed_reply_rate=float(os.getenv("SHED_REPLY_RATE", "5")),
+            shed_key=self.update_user_id,
+            metrics=self.metrics
+        )
+        
+        self.register_metrics()
+        
+    def register_metrics(self):
+        """Describe metrics and register scrape-time gauges"""
+        m = self.metrics
+        m.describe('handler_duration_seconds', 'histogram', 'Update handler latency by command and outcome')
+        m.describe('handler_calls_total', 'counter', 'Update handler calls by command and outcome')
+        m.describe('db_duration_seconds', 'histogram', 'Database statement latency including queueing')
+        m.describe('telegram_api_duration_seconds', 'histogram', 'Bot API call latency by method and status')
+        m.describe('telegram_api_calls_total', 'counter', 'Bot API calls by method and status')
+        m.describe('redemptions_total', 'counter', 'Access code redemptions by outcome')
+        m.describe('pending_shares', 'gauge', 'shared_files rows awaiting deletion')
+        m.describe('dispatch_wait_seconds', 'histogram', 'Time updates waited for a worker by dispatch lane')
+        m.describe('shed_updates_total', 'counter', 'Updates dropped because their dispatch lane was full')
+        m.callback('pending_uploads', lambda: len(self.pending_uploads))
+        m.callback('pending_user_registrations', lambda: self.user_registry.pending_count())
+        m.callback('access_code_cache_entries', lambda: len(self.code_cache))
+        m.callback('active_shares', lambda: len(self.active_shares))
+        m.callback('pending_redemption_events', lambda: self.analytics.pending_count())
+        # Counters owned by other components are read at scrape time
+        for name, fn in {
+            'access_code_cache_hits_total': lambda: self.code_cache.hits,
+            'access_code_cache_misses_total': lambda: self.code_cache.misses,
+            'membership_cache_hits_total': lambda: self.membership_cache.hits,
+            'membership_cache_misses_total': lambda: self.membership_cache.misses,
+            'rate_limited_requests_total': lambda: self.rate_limiter.rejected,
+            'deleted_shares_total': lambda: self.deletion_scheduler.deleted,
+            'reused_shares_total': lambda: self.active_shares.reused,
+            'dropped_redemption_events_total': lambda: self.analytics.dropped,
+        }.items():
+            m.describe(name, 'counter', '')
+            m.callback(name, fn)
+        
+    @staticmethod
+    def update_user_id(update: object) -> Optional[int]:
+        """Sender of an update, if any"""
+        user = update.effective_user if isinstance(update, Update) else None
+        return user.id if user is not None else None
     
-    def generate_access_code(self) -> str:
-        """Generate a unique 8-character access code"""
-        while True:
-            code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("SELECT access_code FROM files WHERE access_code = ?", (code,))
-            if not cursor.fetchone():
-                conn.close()
-                return code
-            conn.close()
+    def classify_update(self, update: object) -> str:
+        """Pick the dispatch lane for an update; must stay a cheap in-memory check"""
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            return 'redemptions'
+        if self.auth.is_owner(user.id):
+            return 'owner'
+        if update.callback_query is not None:
+            return 'callbacks'
+        if self.auth.is_uploader(user.id):
+            return 'uploads'
+        return 'redemptions'
+    
+    async def reply_busy(self, update: object, lane: str):
+        """Tell a user their shed update was not processed"""
+        if not isinstance(update, Update):
+            return
+        text = "⏳ The bot is very busy right now. Please try again in a minute."
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer(text)
+            elif update.effective_message is not None:
+                await update.effective_message.reply_text(text)
+        except TelegramError as e:
+            logger.debug(f"Could not send busy reply for the {lane} lane: {e}")
     
     def add_user(self, user_id: int, username: str = None, first_name: str = None):
-        """Add user to database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR IGNORE INTO users (user_id, username, first_name)
-            VALUES (?, ?, ?)
-        ''', (user_id, username, first_name))
-        conn.commit()
-        conn.close()
-    
-    def is_authorized_uploader(self, user_id: int) -> bool:
-        """Check if user is authorized to upload files"""
-        if user_id == self.owner_id:
-            return True
-            
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM authorized_uploaders WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return bool(result)
+        """Add user to database (batched in the background)"""
+        self.user_registry.add(user_id, username, first_name)
     
     async def check_channel_membership(self, bot: Bot, user_id: int) -> bool:
         """Check if user is member of backup channel"""
-        try:
+        async def fetch() -> bool:
             member = await bot.get_chat_member(self.backup_channel_id, user_id)
             return member.status in ['member', 'administrator', 'creator']
+        
+        try:
+            return await self.membership_cache.get(user_id, fetch)
         except TelegramError:
             return False
     
@@ -149,15 +2918,18 @@ class FileAccessBot:
         """Handle /help command"""
         user_id = update.effective_user.id
         
-        if user_id == self.owner_id:
+        if self.auth.is_owner(user_id):
             help_text = """
 🔧 **Owner Commands:**
 /check_users - View total users count
+/stats - Redemption totals, last 7 days and top files
+/export_stats [days | from to] - Redemption log as CSV (dates as YYYY-MM-DD)
 /broadcast <message> - Send message to all users  
 /authorize <user_id> - Authorize user to upload files
 /revoke <user_id> - Revoke upload permission
 /upload - Upload a new file
-/list_files - List all uploaded files
+/bulk_upload - Upload many files, then /done
+/list_files [by:<id>] [search] - Browse and search uploaded files
 
 👤 **User Commands:**
 Just send an access code to get your file!
@@ -179,18 +2951,26 @@ Need help? Contact the bot owner!
         user_id = update.effective_user.id
         text = update.message.text.strip()
         
+        retry_after = await self.rate_limiter.allow(user_id)
+        if retry_after:
+            if self.rate_limiter.should_warn(user_id):
+                await update.message.reply_text(f"⏳ Too many requests. Please try again in {math.ceil(retry_after)} seconds.")
+            return
+        
         # Check if it's an access code (8 characters, alphanumeric)
         if len(text) == 8 and text.isalnum() and text.isupper():
             await self.handle_access_code(update, context, text)
             return
         
         # Handle upload process
-        if user_id in self.pending_uploads:
-            if self.pending_uploads[user_id]['step'] == 'waiting_code':
+        pending = await self.pending_uploads.get(user_id)
+        if pending is not None:
+            if pending.step == 'waiting_code':
                 # User provided filename/description
                 if len(text) <= 50:
-                    self.pending_uploads[user_id]['description'] = text
-                    self.pending_uploads[user_id]['step'] = 'waiting_file'
+                    pending.description = text
+                    pending.step = 'waiting_file'
+                    await self.pending_uploads.save(user_id, pending)
                     await update.message.reply_text("📎 Now send the file you want to upload.")
                 else:
                     await update.message.reply_text("❌ Description too long. Max 50 characters.")
@@ -212,64 +2992,112 @@ Need help? Contact the bot owner!
                 "⚠️ You must join our backup channel to access files!",
                 reply_markup=reply_markup
             )
+            self.record_redemption(user_id, access_code, 'not_member')
             return
         
         # Check if access code exists
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT file_id, filename FROM files WHERE access_code = ?", (access_code,))
-        result = cursor.fetchone()
-        conn.close()
+        result = await self.code_cache.get(access_code)
         
         if not result:
+            await self.rate_limiter.record_invalid(user_id)
             await update.message.reply_text("❌ Invalid access code. Please check and try again.")
+            self.record_redemption(user_id, access_code, 'invalid')
             return
         
         file_id, filename = result
         
+        # Repeat taps within the window point at the copy already in the chat
+        if await self.reuse_share(context.bot, user_id, access_code):
+            self.record_redemption(user_id, access_code, 'reused')
+            return
+        if not self.active_shares.begin_send(user_id, access_code):
+            await update.message.reply_text("⏳ Your file is on its way.")
+            self.record_redemption(user_id, access_code, 'in_flight')
+            return
+        
         # Send file with deletion warning
         try:
+            await self.send_limiter.acquire()
             message = await context.bot.send_document(
                 chat_id=user_id,
                 document=file_id,
-                caption=f"📁 **{filename}**\n\n⚠️ **This file will be deleted after 15 minutes!**",
-                parse_mode='Markdown'
+                caption=f"📁 <b>{html.escape(filename)}</b>\n\n⚠️ <b>This file will be deleted after 15 minutes!</b>",
+                parse_mode='HTML'
             )
             
-            # Schedule auto-deletion
-            delete_time = datetime.now() + timedelta(minutes=15)
-            
-            # Store in database for deletion tracking
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO shared_files (message_id, chat_id, file_id, delete_at)
-                VALUES (?, ?, ?, ?)
-            ''', (message.message_id, user_id, file_id, delete_time))
-            conn.commit()
-            conn.close()
-            
-            # Schedule deletion
-            context.job_queue.run_once(
-                self.delete_file_callback,
-                when=timedelta(minutes=15),
-                data={'message_id': message.message_id, 'chat_id': user_id}
-            )
+            # Schedule auto-deletion; the periodic sweeper picks it up from the database
+            delete_time = datetime.now() + self.SHARE_TTL
+            share_id = await self.storage.add_share(message.message_id, user_id, file_id, delete_time, access_code)
+            self.active_shares.add(user_id, access_code, share_id, message.message_id, delete_time.timestamp())
             
             logger.info(f"File {filename} shared to user {user_id} with code {access_code}")
+            self.record_redemption(user_id, access_code, 'sent')
             
         except TelegramError as e:
             await update.message.reply_text("❌ Error sending file. Please try again later.")
             logger.error(f"Error sending file: {e}")
+            self.record_redemption(user_id, access_code, 'send_error')
+        finally:
+            self.active_shares.end_send(user_id, access_code)
+    
+    async def reuse_share(self, bot: Bot, user_id: int, access_code: str) -> bool:
+        """Reply to the user's live copy of a file instead of sending it again
+
+        Returns False when there is no usable copy, so the caller sends a new one.
+        """
+        share = await self.active_shares.get(user_id, access_code)
+        if share is None:
+            return False
+        share_id, message_id, delete_at = share
+        remaining = delete_at - time.time()
+        if remaining <= self.SHARE_REUSE_MARGIN:
+            return False
+        
+        if self.extend_repeat_shares:
+            delete_time = datetime.now() + self.SHARE_TTL
+            if not await self.storage.extend_share(share_id, delete_time):
+                self.active_shares.discard(user_id, access_code)
+                return False
+            self.active_shares.add(user_id, access_code, share_id, message_id, delete_time.timestamp())
+            text = "☝️ You already have this file above. Its 15-minute timer has been restarted."
+        else:
+            text = f"☝️ You already have this file above. It will be deleted in {math.ceil(remaining / 60)} minutes."
+        
+        try:
+            await self.send_limiter.acquire()
+            await bot.send_message(chat_id=user_id, text=text, reply_to_message_id=message_id)
+        except BadRequest:
+            # The user deleted the original; send a fresh copy
+            self.active_shares.discard(user_id, access_code)
+            return False
+        except TelegramError as e:
+            # Fall through to a fresh send, whose own error handling replies and records the outcome
+            logger.warning(f"Could not point user {user_id} at their copy of {access_code}: {e}")
+            return False
+        self.active_shares.reused += 1
+        return True
+    
+    def record_redemption(self, user_id: int, access_code: str, outcome: str):
+        """Count a redemption attempt in the metrics and the analytics log"""
+        self.metrics.inc('redemptions_total', {'outcome': outcome})
+        self.analytics.record(user_id, access_code, outcome)
     
     async def check_join_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle 'I Joined' button callback"""
         query = update.callback_query
+        user_id = query.from_user.id
+        
+        retry_after = await self.rate_limiter.allow(user_id)
+        if retry_after:
+            await query.answer(f"⏳ Too many requests. Please try again in {math.ceil(retry_after)} seconds.")
+            return
         await query.answer()
         
-        user_id = query.from_user.id
         access_code = query.data.split(':')[1]
         
+        # The user claims to have joined, so a cached negative result is stale
+        self.membership_cache.invalidate(user_id)
+        
         if await self.check_channel_membership(context.bot, user_id):
             await query.edit_message_text("✅ Great! Now processing your access code...")
             
@@ -286,42 +3114,105 @@ Need help? Contact the bot owner!
             await query.edit_message_text("❌ You have not joined yet! Please join the channel first.")
     
     async def delete_file_callback(self, context: ContextTypes.DEFAULT_TYPE):
-        """Callback to delete shared files after 15 minutes"""
-        data = context.job.data
-        message_id = data['message_id']
-        chat_id = data['chat_id']
-        
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-            
-            # Remove from database
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM shared_files WHERE message_id = ? AND chat_id = ?", (message_id, chat_id))
-            conn.commit()
-            conn.close()
-            
-            logger.info(f"Auto-deleted file message {message_id} from chat {chat_id}")
-            
-        except TelegramError as e:
-            logger.error(f"Error deleting message {message_id}: {e}")
+        """Periodic job deleting shared files whose 15 minutes are up"""
+        await self.deletion_scheduler.sweep(context.bot)
+        self.metrics.set('pending_shares', await self.storage.count_shares())
     
+    async def maintenance_callback(self, context: ContextTypes.DEFAULT_TYPE):
+        """Periodic job adopting orphaned broadcasts and refreshing state other workers change"""
+        await self.broadcast_engine.resume(context.bot)
+        await self.storage.purge_expired()
+        if self.storage.shared:
+            await self.auth.load()
+    
+    @uploader_only
     async def upload_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /upload command"""
         user_id = update.effective_user.id
         
-        if not self.is_authorized_uploader(user_id):
-            await update.message.reply_text("❌ You are not authorized to upload files.")
+        await self.pending_uploads.save(user_id, UploadState('waiting_code'))
+        await update.message.reply_text("📝 Please provide a description for this file (max 50 characters):")
+    
+    @uploader_only
+    async def bulk_upload_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /bulk_upload command"""
+        user_id = update.effective_user.id
+        
+        await self.pending_uploads.save(user_id, UploadState('bulk'))
+        await update.message.reply_text(
+            "📦 Bulk upload started.\n\n"
+            "Send or forward your documents (albums work too). Captions become descriptions, "
+            "otherwise the file name is used. Send /done when finished."
+        )
+    
+    @staticmethod
+    def describe_document(message: Message) -> str:
+        """Derive a description from the caption, falling back to the file name"""
+        text = (message.caption or message.document.file_name or "Untitled").strip()
+        return text.splitlines()[0][:50] if text else "Untitled"
+    
+    async def done_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /done command: store a bulk upload in one transaction"""
+        user_id = update.effective_user.id
+        pending = await self.pending_uploads.get(user_id)
+        
+        if pending is None or pending.step != 'bulk':
+            await update.message.reply_text("❌ Use /bulk_upload command first to start a bulk upload.")
             return
         
-        self.pending_uploads[user_id] = {'step': 'waiting_code'}
-        await update.message.reply_text("📝 Please provide a description for this file (max 50 characters):")
+        if not pending.files:
+            await update.message.reply_text("❌ No documents received yet. Send some files, then /done.")
+            return
+        
+        # Close the session before the insert awaits, so documents arriving meanwhile are refused rather than lost
+        pending = await self.pending_uploads.pop(user_id)
+        if pending is None or pending.step != 'bulk':
+            return
+        files = list(pending.files)
+        
+        # One code allocation pass and one transaction for the whole batch
+        try:
+            codes = await self.code_allocator.insert_files([(file_id, filename, user_id) for file_id, filename in files])
+        except Exception:
+            # Reopen the session so /done can be retried
+            await self.pending_uploads.save(user_id, pending)
+            raise
+        for access_code, (file_id, filename) in zip(codes, files):
+            self.code_cache.put(access_code, file_id, filename)
+        
+        if len(files) <= self.BULK_INLINE_LIMIT:
+            lines = [f"{access_code} - {filename}" for access_code, (_, filename) in zip(codes, files)]
+            await update.message.reply_text(f"✅ {len(files)} files uploaded:\n\n" + "\n".join(lines))
+        else:
+            # Too many for one message; send the codes as a CSV document instead
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(['access_code', 'description', 'file_id'])
+            for access_code, (file_id, filename) in zip(codes, files):
+                writer.writerow([access_code, filename, file_id])
+            await update.message.reply_document(
+                document=InputFile(buffer.getvalue().encode(), filename=f"codes_{datetime.now():%Y%m%d_%H%M%S}.csv"),
+                caption=f"✅ {len(files)} files uploaded. Access codes attached."
+            )
+        
+        logger.info(f"Bulk upload of {len(files)} files by user {user_id}")
     
     async def handle_file_upload(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle file uploads"""
         user_id = update.effective_user.id
+        pending = await self.pending_uploads.get(user_id)
+        
+        if pending is not None and pending.step == 'bulk':
+            if len(pending.files) >= self.BULK_MAX_FILES:
+                await update.message.reply_text(f"❌ Bulk uploads are limited to {self.BULK_MAX_FILES} files. Send /done.")
+                return
+            # Collected silently so an album of hundreds of files gets a single summary on /done
+            entry = (update.message.document.file_id, self.describe_document(update.message))
+            if not await self.pending_uploads.append(user_id, pending, entry):
+                await update.message.reply_text("❌ Use /bulk_upload command first to start a bulk upload.")
+            return
         
-        if user_id not in self.pending_uploads or self.pending_uploads[user_id]['step'] != 'waiting_file':
+        if pending is None or pending.step != 'waiting_file':
             await update.message.reply_text("❌ Use /upload command first to start uploading.")
             return
         
@@ -329,181 +3220,453 @@ Need help? Contact the bot owner!
             await update.message.reply_text("❌ Please send a document file.")
             return
         
-        # Generate access code
-        access_code = self.generate_access_code()
         file_id = update.message.document.file_id
-        filename = self.pending_uploads[user_id]['description']
-        
-        # Store in database
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO files (access_code, file_id, filename, uploaded_by)
-            VALUES (?, ?, ?, ?)
-        ''', (access_code, file_id, filename, user_id))
-        conn.commit()
-        conn.close()
+        filename = pending.description
+        
+        # Store in database; the access code is allocated as part of the insert
+        access_code = await self.code_allocator.insert_file(file_id, filename, user_id)
+        self.code_cache.put(access_code, file_id, filename)
         
         # Clean up pending upload
-        del self.pending_uploads[user_id]
+        await self.pending_uploads.pop(user_id)
         
         await update.message.reply_text(
-            f"✅ **File uploaded successfully!**\n\n"
-            f"🔑 **Access Code:** `{access_code}`\n"
-            f"📁 **Description:** {filename}\n\n"
+            f"✅ <b>File uploaded successfully!</b>\n\n"
+            f"🔑 <b>Access Code:</b> <code>{access_code}</code>\n"
+            f"📁 <b>Description:</b> {html.escape(filename)}\n\n"
             f"Share this code with users to give them access to the file.",
-            parse_mode='Markdown'
+            parse_mode='HTML'
         )
         
         logger.info(f"File uploaded by user {user_id} with code {access_code}")
     
+    @owner_only
     async def check_users_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /check_users command (owner only)"""
-        if update.effective_user.id != self.owner_id:
-            await update.message.reply_text("❌ This command is for the owner only.")
+        total_users = await self.storage.count_users() + self.user_registry.pending_count()
+        
+        await update.message.reply_text(f"👥 **Total Users:** {total_users}")
+    
+    @owner_only
+    async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /stats command (owner only), served from the pre-aggregated counters"""
+        await self.analytics.flush()
+        now = time.time()
+        days = [time.strftime('%Y-%m-%d', time.gmtime(now - 86400 * i)) for i in range(7)]
+        (redemptions, redeemers), daily, top, users = await asyncio.gather(
+            self.storage.redemption_totals(),
+            self.storage.daily_stats(days),
+            self.storage.top_files(10),
+            self.storage.count_users(),
+        )
+        
+        blocks = [
+            "📊 <b>Redemption stats</b>\n\n"
+            f"📥 Total: {redemptions} redemptions by {redeemers} users\n"
+            f"👥 Registered users: {users + self.user_registry.pending_count()}\n\n"
+            "<b>Last 7 days (UTC)</b>\n"
+        ]
+        blocks += [f"{day}: {count} redemptions, {unique} users\n" for day, count, unique in daily]
+        if top:
+            blocks.append("\n<b>Top files</b>\n")
+            blocks += [f"🔑 <code>{code}</code> - {html.escape(filename or '(deleted)')}: {count}\n"
+                       for code, filename, count in top]
+        for chunk in split_message(blocks):
+            await update.message.reply_text(chunk, parse_mode='HTML')
+    
+    @owner_only
+    async def export_stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /export_stats [days | from to] (owner only): the redemption log as CSV"""
+        usage = "❌ Usage: /export_stats [days] or /export_stats <from YYYY-MM-DD> <to YYYY-MM-DD>"
+        today = calendar.timegm(time.gmtime()[:3] + (0, 0, 0))
+        try:
+            if len(context.args) == 2:
+                start = calendar.timegm(time.strptime(context.args[0], '%Y-%m-%d'))
+                end = calendar.timegm(time.strptime(context.args[1], '%Y-%m-%d')) + 86400
+            elif len(context.args) <= 1:
+                days = int(context.args[0]) if context.args else 7
+                start, end = today - 86400 * (days - 1), today + 86400
+            else:
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text(usage)
+            return
+        if end <= start:
+            await update.message.reply_text(usage)
             return
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        conn.close()
+        await self.analytics.flush()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['timestamp', 'user_id', 'access_code', 'outcome'])
+        exported, cursor, truncated = 0, None, False
+        # Page through the log so the export never holds a long read on the hot database
+        while True:
+            rows, cursor = await self.storage.redemption_events(start, end, cursor)
+            if exported + len(rows) > self.EXPORT_MAX_ROWS:
+                rows, truncated = rows[:self.EXPORT_MAX_ROWS - exported], True
+            for ts, user_id, access_code, outcome in rows:
+                writer.writerow([time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts)), user_id, access_code, outcome])
+            exported += len(rows)
+            if truncated or cursor is None:
+                break
         
-        await update.message.reply_text(f"👥 **Total Users:** {total_users}")
+        first_day = time.strftime('%Y-%m-%d', time.gmtime(start))
+        last_day = time.strftime('%Y-%m-%d', time.gmtime(end - 86400))
+        caption = f"📊 {exported} redemption events from {first_day} to {last_day} (UTC)"
+        if truncated:
+            caption += f"\n⚠️ Truncated at {self.EXPORT_MAX_ROWS} rows; export a shorter range for the rest."
+        await update.message.reply_document(
+            document=InputFile(buffer.getvalue().encode(), filename=f"redemptions_{first_day}_{last_day}.csv"),
+            caption=caption
+        )
     
+    @owner_only
     async def broadcast_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /broadcast command (owner only)"""
-        if update.effective_user.id != self.owner_id:
-            await update.message.reply_text("❌ This command is for the owner only.")
-            return
-        
         if not context.args:
             await update.message.reply_text("❌ Usage: /broadcast <your message>")
             return
         
         message = ' '.join(context.args)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users")
-        users = cursor.fetchall()
-        conn.close()
-        
-        sent_count = 0
-        failed_count = 0
-        
         status_msg = await update.message.reply_text("📤 Broadcasting message...")
         
-        for (user_id,) in users:
-            try:
-                await context.bot.send_message(chat_id=user_id, text=f"📢 **Broadcast Message:**\n\n{message}", parse_mode='Markdown')
-                sent_count += 1
-                await asyncio.sleep(0.05)  # Rate limiting
-            except TelegramError:
-                failed_count += 1
-        
-        await status_msg.edit_text(
-            f"✅ **Broadcast Complete!**\n\n"
-            f"📤 Sent: {sent_count}\n"
-            f"❌ Failed: {failed_count}",
-            parse_mode='Markdown'
-        )
+        # Runs in the background; the status message is edited with live counters
+        broadcast_id = await self.broadcast_engine.start(context.bot, message, status_msg)
+        logger.info(f"Broadcast {broadcast_id} started")
     
+    @owner_only
     async def authorize_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /authorize command (owner only)"""
-        if update.effective_user.id != self.owner_id:
-            await update.message.reply_text("❌ This command is for the owner only.")
-            return
-        
         if not context.args or not context.args[0].isdigit():
             await update.message.reply_text("❌ Usage: /authorize <user_id>")
             return
         
         user_id = int(context.args[0])
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR IGNORE INTO authorized_uploaders (user_id, authorized_by)
-            VALUES (?, ?)
-        ''', (user_id, self.owner_id))
-        conn.commit()
-        conn.close()
+        await self.auth.authorize(user_id, update.effective_user.id)
         
         await update.message.reply_text(f"✅ User {user_id} has been authorized to upload files.")
     
+    @owner_only
     async def revoke_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /revoke command (owner only)"""
-        if update.effective_user.id != self.owner_id:
-            await update.message.reply_text("❌ This command is for the owner only.")
-            return
-        
         if not context.args or not context.args[0].isdigit():
             await update.message.reply_text("❌ Usage: /revoke <user_id>")
             return
         
         user_id = int(context.args[0])
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM authorized_uploaders WHERE user_id = ?", (user_id,))
-        affected = cursor.rowcount
-        conn.commit()
-        conn.close()
-        
-        if affected > 0:
+        if await self.auth.revoke(user_id):
             await update.message.reply_text(f"✅ Upload permission revoked for user {user_id}.")
         else:
             await update.message.reply_text(f"❌ User {user_id} was not authorized.")
     
+    @owner_only
     async def list_files_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /list_files command (owner only)"""
-        if update.effective_user.id != self.owner_id:
-            await update.message.reply_text("❌ This command is for the owner only.")
+        """Handle /list_files [by:<uploader_id>] [search terms] (owner only)"""
+        args = list(context.args)
+        uploaded_by = None
+        if args and args[0].startswith('by:'):
+            try:
+                uploaded_by = int(args.pop(0)[3:])
+            except ValueError:
+                await update.message.reply_text("❌ Usage: /list_files [by:<uploader_id>] [search terms]")
+                return
+        query = ' '.join(args) or None
+        
+        chunks, reply_markup = await self.render_files_page(None, uploaded_by, query)
+        for i, chunk in enumerate(chunks):
+            await update.message.reply_text(
+                chunk, parse_mode='HTML', reply_markup=reply_markup if i == len(chunks) - 1 else None
+            )
+    
+    @owner_only
+    async def list_files_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle the pagination buttons under a /list_files page"""
+        query = update.callback_query
+        await query.answer()
+        _, cursor, uploaded_by, search = query.data.split(':', 3)
+        
+        chunks, reply_markup = await self.render_files_page(
+            int(cursor) if cursor else None, int(uploaded_by) if uploaded_by else None, search or None
+        )
+        if len(chunks) == 1:
+            await query.edit_message_text(chunks[0], parse_mode='HTML', reply_markup=reply_markup)
             return
+        for i, chunk in enumerate(chunks):
+            await query.message.reply_text(
+                chunk, parse_mode='HTML', reply_markup=reply_markup if i == len(chunks) - 1 else None
+            )
+    
+    async def render_files_page(self, before_id: Optional[int], uploaded_by: Optional[int],
+                                query: Optional[str]) -> Tuple[List[str], Optional[InlineKeyboardMarkup]]:
+        """Render one catalog page as message chunks plus its navigation keyboard"""
+        # Callback data is capped at 64 bytes, so long searches are cut to fit the buttons
+        prefix = f"files:{{}}:{uploaded_by if uploaded_by is not None else ''}:"
+        room = 64 - len(prefix.format(2 ** 63).encode())
+        if query:
+            query = query.encode()[:room].decode(errors='ignore').strip() or None
+        rows, cursor = await self.storage.list_files(before_id, self.FILES_PAGE_SIZE, uploaded_by, query)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT access_code, filename, upload_date, uploaded_by 
-            FROM files 
-            ORDER BY upload_date DESC 
-            LIMIT 20
-        ''')
-        files = cursor.fetchall()
-        conn.close()
+        title = "📁 <b>Files</b>"
+        if uploaded_by is not None:
+            title += f" by <code>{uploaded_by}</code>"
+        if query:
+            title += f" matching “{html.escape(query)}”"
+        if not rows:
+            blocks = [f"{title}\n\nNo files found."]
+        else:
+            blocks = [f"{title}\n\n"]
+            for _, code, filename, date, uploader, redemptions in rows:
+                redemptions += self.analytics.pending(code)
+                blocks.append(
+                    f"🔑 <code>{code}</code> - {html.escape(filename)}\n"
+                    f"   📅 {date} | 👤 {uploader} | 📥 {redemptions}\n\n"
+                )
+        
+        buttons = []
+        if before_id is not None:
+            buttons.append(InlineKeyboardButton("⏮ Newest", callback_data=prefix.format('') + (query or '')))
+        if cursor is not None:
+            buttons.append(InlineKeyboardButton("Older ▶", callback_data=prefix.format(cursor) + (query or '')))
+        return split_message(blocks), InlineKeyboardMarkup([buttons]) if buttons else None
+    
+    async def healthz(self, headers: Dict[str, str], body: bytes) -> HttpResponse:
+        """Liveness probe: the event loop is serving requests"""
+        return 200, 'text/plain', b'ok'
+    
+    async def readyz(self, headers: Dict[str, str], body: bytes) -> HttpResponse:
+        """Readiness probe: caches are warm and updates are being processed"""
+        if self.ready:
+            return 200, 'text/plain', b'ready'
+        return 503, 'text/plain', b'draining' if self.draining else b'starting'
+    
+    async def metrics_endpoint(self, headers: Dict[str, str], body: bytes) -> HttpResponse:
+        """Prometheus text exposition of the bot's metrics"""
+        return 200, 'text/plain; version=0.0.4', self.metrics.render().encode()
+    
+    def webhook_handler(self, application: Application):
+        """Build the route handler that feeds webhook deliveries into the update queue"""
+        async def handle(headers: Dict[str, str], body: bytes) -> HttpResponse:
+            token = headers.get('x-telegram-bot-api-secret-token', '')
+            # Headers are decoded as latin-1, so any token encodes; str compare_digest rejects non-ASCII
+            if not hmac.compare_digest(token.encode('latin-1'), self.webhook_secret.encode()):
+                return 401, 'text/plain', b'unauthorized'
+            # Updates queued after Application.stop() are never processed; make Telegram redeliver them
+            if self.draining:
+                return 503, 'text/plain', b'draining'
+            
+            try:
+                update = Update.de_json(json.loads(body), application.bot)
+            except ValueError:
+                return 400, 'text/plain', b'bad request'
+            
+            await application.update_queue.put(update)
+            return 200, 'text/plain', b'ok'
+        return handle
+    
+    async def post_init(self, application: Application):
+        """Warm in-memory state before the first update is processed"""
+        # Serve the probes first: /healthz answers during warm-up and /readyz reports 'starting'
+        if self.http_server is not None:
+            self.http_server.route('GET', '/healthz', self.healthz)
+            self.http_server.route('GET', '/readyz', self.readyz)
+            self.http_server.route('GET', '/metrics', self.metrics_endpoint)
+            await self.http_server.start()
         
-        if not files:
-            await update.message.reply_text("📁 No files uploaded yet.")
+        started = time.monotonic()
+        loaders = [
+            self.storage.warm_up(),
+            self.code_cache.warm(),
+            self.auth.load(),
+            self.user_registry.load(),
+            self.pending_uploads.load(),
+            self.storage.count_shares(),
+        ]
+        if not self.storage.shared:
+            loaders.append(self.active_shares.load())
+        results = await asyncio.gather(*loaders)
+        logger.info(f"{results[5]} shared file deletions pending from previous runs")
+        self.user_registry.start()
+        self.analytics.start()
+        await self.broadcast_engine.resume(application.bot)
+        logger.info(f"Warm-up finished in {time.monotonic() - started:.2f}s")
+        
+        if self.mode != "webhook":
+            self.ready = True
+    
+    def begin_drain(self):
+        """Stop taking new work and tell background jobs to wind down"""
+        if self.draining:
             return
+        self.draining = True
+        self.ready = False
+        self._drain_deadline = time.monotonic() + self.shutdown_timeout
+        self.deletion_scheduler.stop()
+        logger.info(f"Draining, {self.shutdown_timeout:.0f}s until shutdown")
+    
+    def _on_stop_signal(self):
+        """Signal handler for polling mode; stops run_polling the same way its own handler does"""
+        self.begin_drain()
+        raise SystemExit
+    
+    async def drain(self, application: Application = None):
+        """Persist scheduler state and flush queued writes before the bot API client closes
+
+        Runs after Application.stop(), which has already finished in-flight updates.
+        Broadcasts and the deletion sweep get most of the remaining budget to reach a
+        chunk boundary; the user and analytics buffers are flushed with the rest.
+        """
+        self.begin_drain()
+        remaining = max(self._drain_deadline - time.monotonic(), 0)
+        cancelled, idle = await asyncio.gather(
+            self.broadcast_engine.stop(timeout=remaining * 0.6),
+            self.deletion_scheduler.wait_idle(remaining * 0.6)
+        )
+        if cancelled:
+            logger.warning(f"Cancelled {cancelled} broadcasts mid-chunk; they resume from their last saved chunk")
+        if not idle:
+            logger.warning("Deletion sweep still running at shutdown; unfinished rows stay due")
+        
+        remaining = max(self._drain_deadline - time.monotonic(), 1.0)
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(self.user_registry.stop(), self.analytics.stop(), self.pending_uploads.stop()), remaining
+            )
+        except asyncio.TimeoutError:
+            logger.error(
+                f"Shutdown deadline reached with {self.user_registry.pending_count()} user registrations "
+                f"and {self.analytics.pending_count()} redemption events unflushed"
+            )
+        logger.info("Drain complete")
+    
+    async def post_shutdown(self, application: Application):
+        """Release storage resources once the application has stopped"""
+        self.ready = False
+        logger.info(f"Access code cache stats: {self.code_cache.stats()}")
+        logger.info(f"Membership cache stats: {self.membership_cache.stats()}")
+        logger.info(f"Rate limiter stats: {self.rate_limiter.stats()}")
+        logger.info(f"Dispatch stats: {self.update_processor.stats()}")
+        # The probes stay up until the end so the platform sees 'draining' rather than a dead port
+        if self.http_server is not None:
+            await self.http_server.stop()
+        await self.storage.close()
+        logger.info("Storage closed")
+    
+    def build_application(self, request: BaseRequest = None) -> Application:
+        """Build the application with every handler and job registered"""
+        logger.info("Building application...")
+        application = (
+            Application.builder()
+            .token(self.bot_token)
+            .request(request or InstrumentedRequest(self.metrics, connection_pool_size=256))
+            .concurrent_updates(self.update_processor)
+            .post_init(self.post_init)
+            .post_stop(self.drain)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
+        
+        # Add handlers
+        logger.info("Adding command handlers...")
+        instrument = self.metrics.instrument
+        application.add_handler(CommandHandler("start", instrument("start", self.start_command)))
+        application.add_handler(CommandHandler("help", instrument("help", self.help_command)))
+        application.add_handler(CommandHandler("upload", instrument("upload", self.upload_command)))
+        application.add_handler(CommandHandler("bulk_upload", instrument("bulk_upload", self.bulk_upload_command)))
+        application.add_handler(CommandHandler("done", instrument("done", self.done_command)))
+        application.add_handler(CommandHandler("check_users", instrument("check_users", self.check_users_command)))
+        application.add_handler(CommandHandler("broadcast", instrument("broadcast", self.broadcast_command)))
+        application.add_handler(CommandHandler("authorize", instrument("authorize", self.authorize_command)))
+        application.add_handler(CommandHandler("revoke", instrument("revoke", self.revoke_command)))
+        application.add_handler(CommandHandler("list_files", instrument("list_files", self.list_files_command)))
+        application.add_handler(CommandHandler("stats", instrument("stats", self.stats_command)))
+        application.add_handler(CommandHandler("export_stats", instrument("export_stats", self.export_stats_command)))
+        application.add_handler(CallbackQueryHandler(instrument("check_join", self.check_join_callback), pattern=r"^check_join:"))
+        application.add_handler(CallbackQueryHandler(instrument("list_files_page", self.list_files_callback), pattern=r"^files:"))
+        application.add_handler(MessageHandler(filters.Document.ALL, instrument("file_upload", self.handle_file_upload)))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument("message", self.handle_message)))
         
-        text = "📁 **Recent Files:**\n\n"
-        for code, filename, date, uploader in files:
-            text += f"🔑 `{code}` - {filename}\n"
-            text += f"   📅 {date} | 👤 {uploader}\n\n"
+        # Sweep due deletions periodically, starting right away to catch up after a restart
+        application.job_queue.run_repeating(
+            instrument("deletion_sweep", self.delete_file_callback),
+            interval=float(os.getenv("DELETION_SWEEP_INTERVAL", "10")),
+            first=0
+        )
+        application.job_queue.run_repeating(
+            instrument("state_maintenance", self.maintenance_callback),
+            interval=float(os.getenv("STATE_REFRESH_INTERVAL", "30")),
+            first=float(os.getenv("STATE_REFRESH_INTERVAL", "30"))
+        )
         
-        await update.message.reply_text(text, parse_mode='Markdown')
+        return application
     
     def run(self):
         """Start the bot"""
         try:
-            logger.info("Building application...")
-            application = Application.builder().token(self.bot_token).build()
+            application = self.build_application()
             
-            # Add handlers
-            logger.info("Adding command handlers...")
-            application.add_handler(CommandHandler("start", self.start_command))
-            application.add_handler(CommandHandler("help", self.help_command))
-            application.add_handler(CommandHandler("upload", self.upload_command))
-            application.add_handler(CommandHandler("check_users", self.check_users_command))
-            
-            # Add more handlers and start the application
-            logger.info("Starting bot...")
-            application.run_polling()
+            logger.info(f"Starting bot in {self.mode} mode...")
+            if self.mode == "webhook":
+                asyncio.run(self.run_webhook(application))
+            else:
+                # Own the stop signals so background jobs start winding down before Application.stop()
+                loop = asyncio.get_event_loop()
+                for sig in (signal.SIGINT, signal.SIGTERM):
+                    loop.add_signal_handler(sig, self._on_stop_signal)
+                application.run_polling(stop_signals=None)
             
         except Exception as e:
             logger.error(f"Error starting bot: {e}")
             raise
+    
+    async def run_webhook(self, application: Application):
+        """Serve updates from Telegram webhooks until SIGINT/SIGTERM"""
+        if not self.webhook_secret:
+            # Every instance behind a load balancer must share the secret, so set WEBHOOK_SECRET there
+            self.webhook_secret = secrets.token_urlsafe(32)
+            logger.warning("WEBHOOK_SECRET not set, generated a per-process secret")
+        self.http_server.route('POST', self.webhook_path, self.webhook_handler(application))
+        
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        def on_stop_signal():
+            self.begin_drain()
+            stop.set()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, on_stop_signal)
+        
+        await application.initialize()
+        try:
+            # Application.initialize() does not call post_init; only run_polling/run_webhook do
+            await self.post_init(application)
+            await application.start()
+            await application.bot.set_webhook(
+                url=self.webhook_url,
+                secret_token=self.webhook_secret,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=min(max(self.concurrent_updates, 1), 100)
+            )
+            logger.info(f"Webhook set to {self.webhook_url}")
+            self.ready = True
+            
+            await stop.wait()
+            logger.info("Stop signal received, shutting down...")
+            await application.stop()
+            await self.drain(application)
+        finally:
+            await application.shutdown()
+            await self.post_shutdown(application)
 
     def some_function():
         pass  # Now properly indented with 4 spaces (or 1 tab)
+
+if __name__ == "__main__":
+    bot = FileAccessBot(
+        bot_token=os.getenv("BOT_TOKEN"),
+        owner_id=int(os.getenv("OWNER_ID", "0")),
+        backup_channel_id=os.getenv("BACKUP_CHANNEL_ID", "")
+    )
+    bot.run()
@@ -0,0 +1,160 @@
+"""Contract tests run against every StateBackend: SQLite on a temp file and Redis on fakeredis"""
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+import main
+
+
+class BackendContract:
+    """Behaviour the bot relies on from any StateBackend"""
+
+    async def make_backend(self, metrics: main.Metrics) -> main.StateBackend:
+        raise NotImplementedError
+
+    async def asyncSetUp(self):
+        self.metrics = main.Metrics()
+        self.backend = await self.make_backend(self.metrics)
+
+    async def asyncTearDown(self):
+        await self.backend.close()
+
+    async def test_lock_is_held_by_one_owner(self):
+        self.assertTrue(await self.backend.acquire_lock('sweep', 'a', ttl=30))
+        self.assertFalse(await self.backend.acquire_lock('sweep', 'b', ttl=30))
+        # The holder renews its own lease
+        self.assertTrue(await self.backend.acquire_lock('sweep', 'a', ttl=30))
+
+    async def test_release_only_by_owner(self):
+        await self.backend.acquire_lock('sweep', 'a', ttl=30)
+        await self.backend.release_lock('sweep', 'b')
+        self.assertFalse(await self.backend.acquire_lock('sweep', 'b', ttl=30))
+        await self.backend.release_lock('sweep', 'a')
+        self.assertTrue(await self.backend.acquire_lock('sweep', 'b', ttl=30))
+
+    async def test_expired_lease_can_be_taken_over(self):
+        await self.backend.acquire_lock('sweep', 'a', ttl=0.05)
+        await asyncio.sleep(0.1)
+        self.assertTrue(await self.backend.acquire_lock('sweep', 'b', ttl=30))
+
+    async def test_insert_files_retries_taken_codes(self):
+        await self.backend.insert_files([('f1', 'one.pdf', 1)], ['TAKEN'], lambda: 'UNUSED')
+        fresh = iter(['TAKEN', 'FRESH'])
+        codes = await self.backend.insert_files([('f2', 'two.pdf', 1), ('f3', 'three.pdf', 1)],
+                                                ['TAKEN', 'OTHER'], lambda: next(fresh))
+        self.assertEqual(codes, ['FRESH', 'OTHER'])
+        self.assertEqual(tuple(await self.backend.get_file('TAKEN')), ('f1', 'one.pdf'))
+        self.assertEqual(tuple(await self.backend.get_file('FRESH')), ('f2', 'two.pdf'))
+
+    async def test_insert_files_gives_up_after_max_attempts(self):
+        await self.backend.insert_files([('f1', 'one.pdf', 1)], ['TAKEN'], lambda: 'UNUSED')
+        with self.assertRaises(RuntimeError):
+            await self.backend.insert_files([('f2', 'two.pdf', 1)], ['TAKEN'], lambda: 'TAKEN', max_attempts=3)
+
+    async def test_upload_state_appends_and_pops(self):
+        expires_at = time.time() + 60
+        await self.backend.save_upload_state(7, 'bulk', None, [], expires_at)
+        await asyncio.gather(*(self.backend.append_upload_file(7, (f'id{i}', f'doc{i}.pdf'), expires_at)
+                               for i in range(10)))
+        step, description, files, state_expires_at = await self.backend.pop_upload_state(7)
+        self.assertEqual(step, 'bulk')
+        self.assertEqual(sorted(files), sorted((f'id{i}', f'doc{i}.pdf') for i in range(10)))
+        self.assertAlmostEqual(state_expires_at, expires_at, delta=1)
+        self.assertIsNone(await self.backend.get_upload_state(7))
+
+    async def test_appended_files_follow_saved_files(self):
+        expires_at = time.time() + 60
+        await self.backend.save_upload_state(7, 'bulk', None, [('id0', 'doc0.pdf')], expires_at)
+        await self.backend.append_upload_file(7, ('id1', 'doc1.pdf'), expires_at)
+        await self.backend.append_upload_file(7, ('id2', 'doc2.pdf'), expires_at)
+        _, _, files, _ = await self.backend.get_upload_state(7)
+        self.assertEqual(files, [('id0', 'doc0.pdf'), ('id1', 'doc1.pdf'), ('id2', 'doc2.pdf')])
+        
+        # Saving again replaces the whole list, appended entries included
+        await self.backend.save_upload_state(7, 'bulk', None, [('id3', 'doc3.pdf')], expires_at)
+        _, _, files, _ = await self.backend.get_upload_state(7)
+        self.assertEqual(files, [('id3', 'doc3.pdf')])
+        self.assertEqual([row[0] for row in await self.backend.load_upload_states(time.time())], [7])
+
+    async def test_append_without_state_is_refused(self):
+        self.assertFalse(await self.backend.append_upload_file(7, ('id', 'doc.pdf'), time.time() + 60))
+        self.assertIsNone(await self.backend.get_upload_state(7))
+
+    async def test_list_files_pages_with_cursor(self):
+        rows = [(f'f{i}', f'report {i}.pdf' if i % 2 else f'photo {i}.jpg', 1 if i < 4 else 2) for i in range(6)]
+        codes = await self.backend.insert_files(rows, [f'CODE{i}' for i in range(6)], lambda: 'UNUSED')
+        
+        pages, cursor = [], None
+        while True:
+            page, cursor = await self.backend.list_files(before_id=cursor, limit=4)
+            pages.append([code for _, code, *_ in page])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [codes[:1:-1], codes[1::-1]])
+        
+        page, cursor = await self.backend.list_files(limit=10, uploaded_by=2)
+        self.assertEqual([code for _, code, *_ in page], ['CODE5', 'CODE4'])
+        self.assertIsNone(cursor)
+
+    async def test_list_files_search_pages_with_cursor(self):
+        rows = [(f'f{i}', f'report {i}.pdf' if i % 2 else f'photo {i}.jpg', 1) for i in range(6)]
+        await self.backend.insert_files(rows, [f'CODE{i}' for i in range(6)], lambda: 'UNUSED')
+        
+        page, cursor = await self.backend.list_files(limit=1, query='REPORT')
+        self.assertEqual([code for _, code, *_ in page], ['CODE5'])
+        page, cursor = await self.backend.list_files(before_id=cursor, limit=5, query='report')
+        self.assertEqual([code for _, code, *_ in page], ['CODE3', 'CODE1'])
+        self.assertIsNone(cursor)
+
+    async def test_counter_ttl_counts_down(self):
+        await self.backend.incr_counter('lockout:7', ttl=60)
+        await self.backend.incr_counter('users')
+        self.assertAlmostEqual(await self.backend.counter_ttl('lockout:7'), 60, delta=1)
+        self.assertEqual(await self.backend.counter_ttl('users'), 0)
+        self.assertEqual(await self.backend.counter_ttl('missing'), 0)
+
+    async def test_list_files_search_matches_word_prefixes(self):
+        rows = [('f0', 'report_2024.pdf', 1), ('f1', 'Quarterly Report.docx', 1), ('f2', 'port map.jpg', 1)]
+        await self.backend.insert_files(rows, ['CODE0', 'CODE1', 'CODE2'], lambda: 'UNUSED')
+        for query, expected in [('rep', ['CODE1', 'CODE0']), ('port', ['CODE2']), ('2024', ['CODE0']),
+                                ('quart rep', ['CODE1']), ('ort', [])]:
+            page, _ = await self.backend.list_files(limit=10, query=query)
+            self.assertEqual([code for _, code, *_ in page], expected, query)
+
+    async def test_commands_are_timed(self):
+        await self.backend.acquire_lock('sweep', 'a', ttl=30)
+        await self.backend.release_lock('sweep', 'a')
+        self.assertGreater(self.metrics.total('db_duration_seconds'), 0)
+
+
+class StorageTest(BackendContract, unittest.IsolatedAsyncioTestCase):
+    async def make_backend(self, metrics: main.Metrics) -> main.StateBackend:
+        workdir = tempfile.TemporaryDirectory(prefix="bot-test-")
+        self.addCleanup(workdir.cleanup)
+        storage = main.Storage(os.path.join(workdir.name, 'file_bot.db'), metrics=metrics)
+        storage.migrate()
+        return storage
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class RedisBackendTest(BackendContract, unittest.IsolatedAsyncioTestCase):
+    async def make_backend(self, metrics: main.Metrics) -> main.StateBackend:
+        return main.RedisBackend(fakeredis.FakeAsyncRedis(decode_responses=True), metrics=metrics)
+
+    async def test_upload_state_keys_expire(self):
+        expires_at = time.time() + 60
+        await self.backend.save_upload_state(7, 'bulk', None, [('id0', 'doc0.pdf')], expires_at)
+        await self.backend.append_upload_file(7, ('id1', 'doc1.pdf'), expires_at)
+        for key in self.backend._upload_keys(7):
+            self.assertGreater(await self.backend.redis.pttl(key), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()